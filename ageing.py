@@ -0,0 +1,74 @@
+"""
+Ageing cache for ICS (public-safe)
+
+- Materialises, per currently-present invoice, what the dashboard's ageing
+  view needs: first-seen as a Julian day number, Ready/Manual lane, gross
+- Writes:
+    - invoice_ageing (current cache, full-replace per run)
+- Kept in step with inbox_invoice: every writer that changes an ageing input
+  (is_currently_present, ready_to_post, gross_total) calls write_ageing_rows
+  inside its own write transaction, so the cache commits with the change
+
+Why a Julian day and not an age:
+- julianday(first_seen_datetime) is fixed once the invoice is first seen, so
+  the dashboard can compute "age as of now" with a single julianday('now')
+  instead of parsing every first_seen_datetime string on each refresh
+- Ages therefore stay correct between pipeline runs
+"""
+
+from __future__ import annotations
+
+import sqlite3
+from datetime import datetime, timezone
+
+
+def _utc_now_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def write_ageing_rows(conn: sqlite3.Connection) -> int:
+    """
+    Full-replace invoice_ageing from inbox_invoice truth, inside the caller's
+    open write transaction (no BEGIN/COMMIT here).
+
+    Lane follows the canonical readiness flag (ready_to_post = 1 -> Ready).
+
+    Returns:
+        number of rows written.
+    """
+    conn.execute("DELETE FROM invoice_ageing;")
+    cur = conn.execute(
+        """
+        INSERT INTO invoice_ageing (
+            document_hash,
+            first_seen_julian,
+            lane,
+            gross_total,
+            generated_at_utc
+        )
+        SELECT
+            document_hash,
+            julianday(first_seen_datetime),
+            CASE WHEN ready_to_post = 1 THEN 'Ready' ELSE 'Manual' END,
+            gross_total,
+            ?
+        FROM inbox_invoice
+        WHERE is_currently_present = 1;
+        """,
+        (_utc_now_iso(),),
+    )
+
+    return cur.rowcount
+
+
+def refresh_ageing_table(conn: sqlite3.Connection) -> int:
+    """
+    write_ageing_rows in a transaction of its own (backfill / manual refresh).
+
+    Returns:
+        number of rows written.
+    """
+    with conn:
+        # Explicit: connections run with isolation_level=None (no implicit BEGIN)
+        conn.execute("BEGIN IMMEDIATE")
+        return write_ageing_rows(conn)
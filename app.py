@@ -1,19 +1,24 @@
 from __future__ import annotations
 
 import os
-from datetime import datetime, timezone
+import sqlite3
 from pathlib import Path
-from typing import Any, List, Dict
+from typing import Any
 
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
 
 from dashboard_data import (
+    get_connection,
+    iter_column_batches,
+    load_core_aggregates_data,
     load_overview_data,
     load_status_breakdown_data,
     load_ageing_buckets_data,
     load_trends_data,
-    load_worklist_data,
+    load_worklist_filter_options_data,
+    worklist_query,
 )
 
 # =============================================================================
@@ -52,6 +57,11 @@ def pence_to_gbp_str(pence: Any) -> str:
     return f"£{v:,.2f}"
 
 
+def pence_to_gbp_series(pence: pd.Series) -> pd.Series:
+    # Column-wise pence_to_gbp_str (missing/non-numeric -> £0.00)
+    return (pd.to_numeric(pence, errors="coerce").fillna(0) / 100).map("£{:,.2f}".format).astype(object)
+
+
 def pct_str(value: Any) -> str:
     if value is None:
         return "—"
@@ -70,59 +80,128 @@ def days_str(value: Any) -> str:
         return "—"
 
 
-def parse_iso_dt(value: Any) -> datetime | None:
-    if not value:
-        return None
+# -------------------- Cached data access --------------------
+# Loaders are keyed on the DB's change token, so reruns (filter changes,
+# toggles) hit the cache until the pipeline actually writes; the long TTL is
+# only a backstop for the time-relative fields (ageing, oldest days).
+CACHE_TTL_SECONDS = 3600
+_CACHE_KW = dict(show_spinner=False, ttl=CACHE_TTL_SECONDS, hash_funcs={Path: str})
+
+
+def db_file_id(db_path: Path) -> tuple[int, int]:
+    # (device, inode): changes when the DB is deleted/replaced at the same path
     try:
-        s = str(value).replace("Z", "+00:00")
-        dt = datetime.fromisoformat(s)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt
-    except Exception:
-        return None
+        stat = db_path.stat()
+    except OSError:
+        return 0, 0
+    return stat.st_dev, stat.st_ino
+
+
+def db_version(db_path: Path) -> tuple[int, ...]:
+    # File identity + main file and WAL sidecar mtimes (WAL-mode writes land in -wal first)
+    def _mtime_ns(p: Path) -> int:
+        try:
+            return p.stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    return (
+        *db_file_id(db_path),
+        _mtime_ns(db_path),
+        _mtime_ns(db_path.with_name(db_path.name + "-wal")),
+    )
 
 
-# -------------------- Cached data access --------------------
-@st.cache_data(show_spinner=False, ttl=10)
-def load_overview():
-    return load_overview_data(DB_PATH)
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _open_db(db_path: str, file_id: tuple[int, int]) -> sqlite3.Connection:
+    # One read-only handle per DB file (keeps page cache warm); keyed on the
+    # inode so a DB replaced at the same path gets a fresh handle
+    return get_connection(Path(db_path))
+
+
+def db_connection(db_path: str) -> sqlite3.Connection:
+    return _open_db(db_path, db_file_id(Path(db_path)))
 
 
-@st.cache_data(show_spinner=False, ttl=10)
-def load_status_breakdown():
-    return load_status_breakdown_data(DB_PATH)
+@st.cache_data(**_CACHE_KW)
+def load_core_aggregates(db_path: Path, version: tuple[int, ...]):
+    # Single scan shared by the overview metrics and the status breakdown
+    return load_core_aggregates_data(db_connection(str(db_path)))
 
 
-@st.cache_data(show_spinner=False, ttl=10)
-def load_ageing_buckets():
-    return load_ageing_buckets_data(DB_PATH)
+@st.cache_data(**_CACHE_KW)
+def load_overview(db_path: Path, version: tuple[int, ...]):
+    return load_overview_data(db_connection(str(db_path)), core=load_core_aggregates(db_path, version))
 
 
-@st.cache_data(show_spinner=False, ttl=10)
-def load_worklist():
-    return load_worklist_data(DB_PATH)
+@st.cache_data(**_CACHE_KW)
+def load_status_breakdown(db_path: Path, version: tuple[int, ...]):
+    return load_status_breakdown_data(db_connection(str(db_path)), core=load_core_aggregates(db_path, version))
 
 
-@st.cache_data(show_spinner=False, ttl=30)
-def load_trends():
-    return load_trends_data(DB_PATH)
+@st.cache_data(**_CACHE_KW)
+def load_ageing_buckets(db_path: Path, version: tuple[int, ...]):
+    return load_ageing_buckets_data(db_connection(str(db_path)))
+
+
+@st.cache_data(**_CACHE_KW)
+def load_worklist_filter_options(db_path: Path, version: tuple[int, ...]):
+    return load_worklist_filter_options_data(db_connection(str(db_path)))
+
+
+def _read_worklist(
+    conn: sqlite3.Connection,
+    next_action: str | None,
+    action_reason: str | None,
+    domain_substr: str | None,
+) -> pd.DataFrame:
+    # SQLite -> Arrow batches -> Arrow-backed frame (no Row -> dict -> DataFrame hops).
+    query = worklist_query(
+        conn,
+        next_action=next_action,
+        action_reason=action_reason,
+        domain_substr=domain_substr,
+    )
+    if query is None:
+        return pd.DataFrame()
+
+    sql, params = query
+    batches = [pa.Table.from_pydict(b) for b in iter_column_batches(conn, sql, params)]
+    if not batches:
+        return pd.DataFrame()
+
+    # promote: an all-NULL column in one batch must not clash with a typed one in another
+    return pa.concat_tables(batches, promote_options="default").to_pandas(types_mapper=pd.ArrowDtype)
 
 
-def _worklist_to_dataframe(rows: List[Dict[str, Any]]) -> pd.DataFrame:
+@st.cache_data(**_CACHE_KW)
+def load_worklist(
+    db_path: Path,
+    version: tuple[int, ...],
+    next_action: str | None = None,
+    action_reason: str | None = None,
+    domain_substr: str | None = None,
+) -> pd.DataFrame:
+    # Read + display transform cached together; filter args are part of the cache key,
+    # so a repeat render with the same filters does no SQL and no pandas work.
+    raw = _read_worklist(db_connection(str(db_path)), next_action, action_reason, domain_substr)
+    return _worklist_to_dataframe(raw)
+
+
+@st.cache_data(**_CACHE_KW)
+def load_trends(db_path: Path, version: tuple[int, ...]):
+    return load_trends_data(db_connection(str(db_path)))
+
+
+def _worklist_to_dataframe(raw: pd.DataFrame) -> pd.DataFrame:
     """
-    Convert worklist rows into a dataframe suitable for sorting/filtering.
+    Convert the loaded worklist frame into a dataframe suitable for sorting/filtering.
 
     Adds:
     - Gross £ (derived if gross_pence exists)
-    - Received (parsed datetime for proper sorting; displayed as string)
+    - Received (display string; rows arrive already sorted from SQL)
     """
-    if not rows:
-        return pd.DataFrame()
-
-    df = pd.DataFrame(rows)
-
-    # Normalise expected columns (public-safe; tolerate missing)
+    # Normalise expected columns (public-safe; any missing come back all-NA)
     expected = [
         "priority",
         "next_action",
@@ -135,36 +214,40 @@ def _worklist_to_dataframe(rows: List[Dict[str, Any]]) -> pd.DataFrame:
         "is_currently_present",
         "gross_pence",
     ]
-    for col in expected:
-        if col not in df.columns:
-            df[col] = None
-
-    # Friendly fields
-    df["Gross £"] = df["gross_pence"].apply(lambda x: pence_to_gbp_str(x) if x is not None else "—")
-    df["Received"] = df["received_datetime"].apply(fmt_dt)
-
-    # Parsed datetime for correct sorting (hidden column)
-    df["_received_dt"] = df["received_datetime"].apply(parse_iso_dt)
-
-    # Choose display order (keep hash at the end)
-    display_cols = [
-        "priority",
-        "next_action",
-        "action_reason",
-        "Gross £",
-        "sender_domain",
-        "Received",
-        "email_subject",
-        "attachment_name",
-        "document_hash",
+    df = raw.reindex(columns=expected)
+
+    # Friendly fields (vectorised; no per-row Python)
+    gross = pd.to_numeric(df["gross_pence"], errors="coerce")
+    df["Gross £"] = pence_to_gbp_series(gross).where(gross.notna(), "—")
+
+    received = (
+        df["received_datetime"]
+        .astype("string")
+        .str.replace("T", " ", regex=False)
+        .str.replace("+00:00", "", regex=False)
+        .str.replace("Z", "", regex=False)
+    )
+    df["Received"] = received.where(received.fillna("") != "", "—").astype(object)
+
+    # Few distinct values across many rows: store as codes (smaller frame, cheaper Arrow serialisation)
+    for col in ("next_action", "action_reason", "sender_domain"):
+        df[col] = df[col].astype("category")
+
+    # Choose display order (keep hash at the end); every column exists after the reindex above
+    return df[
+        [
+            "priority",
+            "next_action",
+            "action_reason",
+            "Gross £",
+            "sender_domain",
+            "Received",
+            "email_subject",
+            "attachment_name",
+            "document_hash",
+        ]
     ]
 
-    # Only keep columns that exist (defensive)
-    display_cols = [c for c in display_cols if c in df.columns]
-    df = df[display_cols + (["_received_dt"] if "_received_dt" in df.columns else [])]
-
-    return df
-
 
 # -------------------- UI --------------------
 st.set_page_config(page_title=APP_TITLE, layout="wide")
@@ -178,7 +261,16 @@ with st.sidebar:
     st.caption("Run")
     st.code("streamlit run app.py", language="bash")
 
-m = load_overview()
+# Change token computed once per full rerun; every cached loader keys on it
+# (fragments recompute their own, since a fragment rerun skips this line)
+DB_VERSION = db_version(DB_PATH)
+
+if not DB_PATH.exists():
+    # The dashboard opens read-only, so it cannot create the DB itself
+    st.error(f"Database not found: {DB_PATH} (run the pipeline first)")
+    st.stop()
+
+m = load_overview(DB_PATH, DB_VERSION)
 if "_error" in m:
     st.error(m["_error"])
     st.stop()
@@ -189,7 +281,16 @@ st.caption("Disclosure: Exposure values may include a median-based estimate wher
 tabs = st.tabs(["Overview", "Worklist", "Exceptions", "Ageing", "Trends"])
 
 # ---------------- Tab 1: Overview ----------------
-with tabs[0]:
+@st.fragment
+def overview_tab() -> None:
+    # Fragment: the breakdown toggle reruns this tab only. A fragment rerun does
+    # not re-execute the module body, so take a fresh change token here rather
+    # than reading DB_VERSION (same token on a full run -> cache hit)
+    m = load_overview(DB_PATH, db_version(DB_PATH))
+    if "_error" in m:
+        st.error(m["_error"])
+        return
+
     show_breakdown = st.toggle("Show exposure breakdown (Known vs Estimated)", value=False)
 
     c1, c2, c3, c4 = st.columns([1.4, 1.2, 1.2, 0.9])
@@ -261,65 +362,61 @@ with tabs[0]:
     st.subheader("Total Estimated Exposure Over Time")
     st.caption("Use the Trends tab once snapshotting is enabled.")
 
+
+with tabs[0]:
+    overview_tab()
+
 # ---------------- Tab 2: Worklist ----------------
-with tabs[1]:
+@st.fragment
+def worklist_tab() -> None:
+    # Fragment: filter changes rerun this tab only, not the other loaders
     st.subheader("Worklist")
     st.caption(
         "This is the current AP queue computed from the database truth. "
         "Click a column header to sort. Use filters to narrow down."
     )
 
-    rows = load_worklist()
-    if not rows:
+    # Fresh change token per fragment rerun (see overview_tab): a filter change
+    # after the pipeline has written must miss the cache, not wait out the TTL
+    version = db_version(DB_PATH)
+    options = load_worklist_filter_options(DB_PATH, version)
+    if not options["total"]:
         st.info("No worklist rows available. Run the pipeline to generate invoice_worklist.")
     else:
-        df = _worklist_to_dataframe(rows)
-
-        # Filters (simple, fast, public-friendly)
+        # Filters (simple, fast, public-friendly); applied in SQL by the loader
         c1, c2, c3 = st.columns([1.0, 1.2, 1.2])
 
         with c1:
-            actions = ["All"] + sorted([a for a in df["next_action"].dropna().unique().tolist() if str(a).strip()])
+            actions = ["All"] + options["next_actions"]
             action_filter = st.selectbox("Next action", actions, index=0)
 
         with c2:
-            reasons = ["All"] + sorted([a for a in df["action_reason"].dropna().unique().tolist() if str(a).strip()])
+            reasons = ["All"] + options["action_reasons"]
             reason_filter = st.selectbox("Reason", reasons, index=0)
 
         with c3:
             domain_val = st.text_input("Sender domain contains", value="")
 
-        filtered = df.copy()
-
-        if action_filter != "All":
-            filtered = filtered[filtered["next_action"] == action_filter]
-
-        if reason_filter != "All":
-            filtered = filtered[filtered["action_reason"] == reason_filter]
-
-        if domain_val.strip():
-            needle = domain_val.strip().lower()
-            filtered = filtered[
-                filtered["sender_domain"].fillna("").astype(str).str.lower().str.contains(needle, na=False)
-            ]
-
-        # Default sort (priority asc, then received desc)
-        if "_received_dt" in filtered.columns:
-            filtered = filtered.sort_values(by=["priority", "_received_dt"], ascending=[True, False])
-
-        # Hide helper sort column
-        if "_received_dt" in filtered.columns:
-            filtered_display = filtered.drop(columns=["_received_dt"])
-        else:
-            filtered_display = filtered
+        filtered = load_worklist(
+            DB_PATH,
+            version,
+            next_action=None if action_filter == "All" else action_filter,
+            action_reason=None if reason_filter == "All" else reason_filter,
+            domain_substr=domain_val.strip().lower() or None,
+        )
 
+        # Already in default order from SQL (priority asc, then received desc)
         st.dataframe(
-            filtered_display,
+            filtered,
             use_container_width=True,
             hide_index=True,
         )
 
-        st.caption(f"Showing {len(filtered_display)} of {len(df)} worklist item(s).")
+        st.caption(f"Showing {len(filtered)} of {options['total']} worklist item(s).")
+
+
+with tabs[1]:
+    worklist_tab()
 
 # ---------------- Tab 3: Exceptions ----------------
 with tabs[2]:
@@ -329,7 +426,7 @@ with tabs[2]:
         "Values include only invoices where a gross total is available."
     )
 
-    breakdown = load_status_breakdown()
+    breakdown = load_status_breakdown(DB_PATH, DB_VERSION)
     if not breakdown:
         st.info("No status breakdown available (missing `po_match_status` or no invoices present).")
     else:
@@ -346,14 +443,14 @@ with tabs[2]:
 
         st.divider()
 
-        table = [
+        bd = pd.DataFrame(breakdown)
+        table = pd.DataFrame(
             {
-                "Status": r.get("status"),
-                "Count": int(r.get("cnt", 0)),
-                "Known total (£)": pence_to_gbp_str(r.get("gross_pence")),
+                "Status": bd["status"],
+                "Count": bd["cnt"],
+                "Known total (£)": pence_to_gbp_series(bd["gross_pence"]),
             }
-            for r in breakdown
-        ]
+        )
         st.dataframe(table, use_container_width=True, hide_index=True)
 
 # ---------------- Tab 4: Ageing ----------------
@@ -361,34 +458,29 @@ with tabs[3]:
     st.subheader("Ageing Buckets")
     st.caption("Age is calculated from first seen datetime. Values include only invoices where a gross total is available.")
 
-    rows = load_ageing_buckets()
+    rows = load_ageing_buckets(DB_PATH, DB_VERSION)
     if not rows:
         st.info("No invoices currently present.")
     else:
-        buckets: dict[str, dict[str, dict[str, Any]]] = {}
-        for r in rows:
-            b = r.get("age_bucket")
-            lane = r.get("lane")
-            buckets.setdefault(b, {})
-            buckets[b][lane] = {
-                "cnt": int(r.get("cnt", 0)),
-                "gross": pence_to_gbp_str(r.get("gross_pence")),
-            }
-
-        out = []
         order = ["0-1 days", "2-3 days", "4-7 days", "8-14 days", "15+ days"]
-        for b in order:
-            ready = buckets.get(b, {}).get("Ready", {"cnt": 0, "gross": pence_to_gbp_str(0)})
-            manual = buckets.get(b, {}).get("Manual", {"cnt": 0, "gross": pence_to_gbp_str(0)})
-            out.append(
-                {
-                    "Age bucket": b,
-                    "Ready count": ready["cnt"],
-                    "Ready £": ready["gross"],
-                    "Manual count": manual["cnt"],
-                    "Manual £": manual["gross"],
-                }
-            )
+        lanes = ["Ready", "Manual"]
+
+        # One pivot: bucket rows x (metric, lane) columns; absent cells -> 0
+        pivot = (
+            pd.DataFrame(rows)
+            .pivot_table(index="age_bucket", columns="lane", values=["cnt", "gross_pence"], aggfunc="sum", fill_value=0)
+            .reindex(index=order, columns=pd.MultiIndex.from_product([["cnt", "gross_pence"], lanes]), fill_value=0)
+        )
+
+        out = pd.DataFrame(
+            {
+                "Age bucket": order,
+                "Ready count": pivot[("cnt", "Ready")].astype(int).to_numpy(),
+                "Ready £": pence_to_gbp_series(pivot[("gross_pence", "Ready")]).to_numpy(),
+                "Manual count": pivot[("cnt", "Manual")].astype(int).to_numpy(),
+                "Manual £": pence_to_gbp_series(pivot[("gross_pence", "Manual")]).to_numpy(),
+            }
+        )
 
         st.dataframe(out, use_container_width=True, hide_index=True)
 
@@ -400,7 +492,7 @@ with tabs[4]:
         "Snapshots let you track exposure and workload trends over time."
     )
 
-    trends = load_trends()
+    trends = load_trends(DB_PATH, DB_VERSION)
     if not trends:
         st.info("Snapshotting not enabled yet.")
     else:
@@ -4,7 +4,9 @@ import sqlite3
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
+
+from db import SchemaCachedConnection, schema_columns
 
 """
 Reads aggregated metrics from SQLite only.
@@ -27,8 +29,27 @@ class ReadinessRule:
 
 
 def get_connection(db_path: Path) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    """
+    Read-only connection for the dashboard loaders.
+
+    Opened with mode=ro so the dashboard can never write (or create a missing
+    file at db_path); journal mode and schema are owned by the writer in db.py.
+    Autocommit (isolation_level=None) so a long-lived handle never pins a
+    read transaction, and not bound to the opening thread so the dashboard
+    can hold one connection across reruns.
+    """
+    conn = sqlite3.connect(
+        f"{Path(db_path).resolve().as_uri()}?mode=ro",
+        uri=True,
+        check_same_thread=False,
+        isolation_level=None,
+        factory=SchemaCachedConnection,
+    )
     conn.row_factory = sqlite3.Row
+    # Read-side tuning only (journal mode is owned by the writer in db.py)
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -65536;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
     return conn
 
 
@@ -43,22 +64,47 @@ def fetch_rows(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> list[s
     return conn.execute(sql, params).fetchall()
 
 
+def _tuple_cursor(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+    """
+    Execute on a cursor that yields plain tuples, skipping the connection's
+    sqlite3.Row factory for bulk reads that never index rows by name.
+    """
+    cur = conn.cursor()
+    cur.row_factory = None
+    return cur.execute(sql, params)
+
+
+def iter_column_batches(
+    conn: sqlite3.Connection,
+    sql: str,
+    params: tuple = (),
+    *,
+    batch_size: int = 2048,
+) -> Iterator[dict[str, list[Any]]]:
+    """
+    Stream a query as column-major batches ({column: values}) of up to
+    batch_size rows, so large results never exist as one list of rows.
+    """
+    cur = _tuple_cursor(conn, sql, params)
+    cols = [d[0] for d in cur.description]
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield dict(zip(cols, map(list, zip(*rows))))
+
+
+# Schema metadata comes from db.schema_columns: cached per connection (see
+# get_connection) and re-read when schema_version changes, so
+# a pipeline run that creates/migrates tables is picked up without a restart.
+
+
 def table_exists(conn: sqlite3.Connection, name: str) -> bool:
-    return (
-        scalar(
-            conn,
-            "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ? LIMIT 1;",
-            (name,),
-        )
-        is not None
-    )
+    return name in schema_columns(conn)
 
 
 def get_table_columns(conn: sqlite3.Connection, table: str) -> set[str]:
-    if not table_exists(conn, table):
-        return set()
-    rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
-    return {r["name"] for r in rows}
+    return set(schema_columns(conn).get(table, ()))
 
 
 def build_readiness_rule(invoice_cols: set[str]) -> ReadinessRule:
@@ -90,13 +136,6 @@ def build_readiness_rule(invoice_cols: set[str]) -> ReadinessRule:
     )
 
 
-def pence_or_zero(pence: Any) -> int:
-    try:
-        return int(pence) if pence is not None else 0
-    except (TypeError, ValueError):
-        return 0
-
-
 def parse_iso_dt(value: Any) -> datetime | None:
     if not value:
         return None
@@ -110,295 +149,337 @@ def parse_iso_dt(value: Any) -> datetime | None:
         return None
 
 
-def load_overview_data(db_path: Path) -> dict[str, Any]:
-    with get_connection(db_path) as conn:
-        if not table_exists(conn, "inbox_invoice"):
-            return {"_error": "Missing table: inbox_invoice"}
+def _sum_or_none(values: Iterable[Any]) -> Any:
+    # SQL SUM semantics: NULL when there is nothing to add
+    present = [v for v in values if v is not None]
+    return sum(present) if present else None
 
-        invoice_cols = get_table_columns(conn, "inbox_invoice")
-        rule = build_readiness_rule(invoice_cols)
 
-        total_present = int(
-            scalar(conn, "SELECT COUNT(*) FROM inbox_invoice WHERE is_currently_present = 1") or 0
-        )
+def load_core_aggregates_data(conn: sqlite3.Connection) -> dict[str, Any] | None:
+    """
+    One GROUP BY scan over the present invoices, shared by the overview
+    metrics and the status breakdown.
 
-        ready_count = int(
-            scalar(
-                conn,
-                f"""
-                SELECT COUNT(*)
-                FROM inbox_invoice
-                WHERE is_currently_present = 1
-                  AND ({rule.ready_predicate_sql})
-                """,
-                rule.ready_params,
-            )
-            or 0
-        )
+    Groups are (po_match_status, is_ready). Every readiness rule's manual
+    predicate is the complement of its ready predicate, so manual figures
+    are derived as "not ready".
 
-        manual_count = int(
-            scalar(
-                conn,
-                f"""
-                SELECT COUNT(*)
-                FROM inbox_invoice
-                WHERE is_currently_present = 1
-                  AND ({rule.manual_predicate_sql})
-                """,
-                rule.manual_params,
-            )
-            or 0
-        )
+    Returns None if inbox_invoice is missing.
+    """
+    if not table_exists(conn, "inbox_invoice"):
+        return None
 
-        po_confidence = round((ready_count / total_present) * 100, 1) if total_present else None
-        last_scan = scalar(conn, "SELECT MAX(last_scan_datetime) FROM inbox_invoice")
+    invoice_cols = get_table_columns(conn, "inbox_invoice")
+    rule = build_readiness_rule(invoice_cols)
+    has_status = "po_match_status" in invoice_cols
+    has_value = "gross_total IS NOT NULL AND gross_total > 0"
+
+    rows = fetch_rows(
+        conn,
+        f"""
+        SELECT
+            {"po_match_status" if has_status else "NULL"} AS status,
+            CASE WHEN ({rule.ready_predicate_sql}) THEN 1 ELSE 0 END AS is_ready,
+            COUNT(*) AS cnt,
+            SUM(CASE WHEN {has_value} THEN gross_total END) AS gross_sum,
+            COALESCE(SUM(CASE WHEN {has_value} THEN gross_total END), 0) AS gross_pence,
+            SUM(CASE WHEN {has_value} THEN 1 ELSE 0 END) AS with_value,
+            MAX(CASE WHEN {has_value} THEN gross_total END) AS biggest,
+            MIN(first_seen_datetime) AS oldest_first_seen
+        FROM inbox_invoice
+        WHERE is_currently_present = 1
+        GROUP BY status, is_ready
+        """,
+        rule.ready_params,
+    )
 
-        oldest_first_seen = scalar(
-            conn,
-            """
-            SELECT MIN(first_seen_datetime)
-            FROM inbox_invoice
-            WHERE is_currently_present = 1
-            """,
-        )
-        oldest_days = None
-        dt_oldest = parse_iso_dt(oldest_first_seen)
-        if dt_oldest:
-            oldest_days = (datetime.now(dt_oldest.tzinfo) - dt_oldest).days
+    return {
+        "readiness_source": rule.source,
+        "has_status": has_status,
+        "groups": [dict(r) for r in rows],
+    }
 
-        known_exposure_pence = scalar(
-            conn,
-            """
-            SELECT SUM(gross_total)
-            FROM inbox_invoice
-            WHERE is_currently_present = 1
-              AND gross_total IS NOT NULL
-              AND gross_total > 0
-            """,
-        )
 
-        biggest_invoice_pence = scalar(
+def load_overview_data(conn: sqlite3.Connection, core: dict[str, Any] | None = None) -> dict[str, Any]:
+    """
+    Headline metrics. Pass `core` (from load_core_aggregates_data) to reuse
+    a scan already made for the status breakdown.
+    """
+    if core is None:
+        core = load_core_aggregates_data(conn)
+    if core is None:
+        return {"_error": "Missing table: inbox_invoice"}
+
+    groups = core["groups"]
+    ready_groups = [g for g in groups if g["is_ready"]]
+    manual_groups = [g for g in groups if not g["is_ready"]]
+
+    total_present = sum(g["cnt"] for g in groups)
+    ready_count = sum(g["cnt"] for g in ready_groups)
+    manual_count = sum(g["cnt"] for g in manual_groups)
+
+    po_confidence = round((ready_count / total_present) * 100, 1) if total_present else None
+    last_scan = scalar(conn, "SELECT MAX(last_scan_datetime) FROM inbox_invoice")
+
+    oldest_days = None
+    oldest_first_seen = min((g["oldest_first_seen"] for g in groups if g["oldest_first_seen"]), default=None)
+    dt_oldest = parse_iso_dt(oldest_first_seen)
+    if dt_oldest:
+        oldest_days = (datetime.now(dt_oldest.tzinfo) - dt_oldest).days
+
+    known_exposure_pence = _sum_or_none(g["gross_sum"] for g in groups)
+    biggest_invoice_pence = max((g["biggest"] for g in groups if g["biggest"] is not None), default=None)
+
+    value_covered = sum(g["with_value"] for g in groups)
+    missing_value_count = max(total_present - value_covered, 0)
+    value_coverage_pct = round((value_covered / total_present) * 100, 1) if total_present else None
+
+    # Median of the known values: value_covered is already known, so seek
+    # straight to the middle one/two rows instead of re-counting in SQL.
+    median_gross_pence = None
+    if value_covered:
+        middle = fetch_rows(
             conn,
             """
-            SELECT MAX(gross_total)
+            SELECT gross_total
             FROM inbox_invoice
             WHERE is_currently_present = 1
               AND gross_total IS NOT NULL
               AND gross_total > 0
+            ORDER BY gross_total
+            LIMIT ? OFFSET ?
             """,
+            (2 - value_covered % 2, (value_covered - 1) // 2),
         )
+        if middle:
+            median_gross_pence = sum(r["gross_total"] for r in middle) / len(middle)
 
-        value_covered = int(
-            scalar(
-                conn,
-                """
-                SELECT SUM(CASE WHEN gross_total IS NOT NULL AND gross_total > 0 THEN 1 ELSE 0 END)
-                FROM inbox_invoice
-                WHERE is_currently_present = 1
-                """,
-            )
-            or 0
-        )
-        missing_value_count = max(total_present - value_covered, 0)
-        value_coverage_pct = round((value_covered / total_present) * 100, 1) if total_present else None
+    estimated_missing_exposure_pence = None
+    if missing_value_count > 0 and median_gross_pence is not None:
+        estimated_missing_exposure_pence = int(float(median_gross_pence)) * missing_value_count
 
-        median_gross_pence = scalar(
-            conn,
-            """
-            SELECT AVG(gross_total) FROM (
-                SELECT gross_total
-                FROM inbox_invoice
-                WHERE is_currently_present = 1
-                  AND gross_total IS NOT NULL
-                  AND gross_total > 0
-                ORDER BY gross_total
-                LIMIT 2 - (SELECT COUNT(*) FROM inbox_invoice
-                           WHERE is_currently_present = 1
-                             AND gross_total IS NOT NULL
-                             AND gross_total > 0) % 2
-                OFFSET (SELECT (COUNT(*) - 1) / 2 FROM inbox_invoice
-                        WHERE is_currently_present = 1
-                          AND gross_total IS NOT NULL
-                          AND gross_total > 0)
-            )
-            """,
-        )
+    # SQLite hands back typed INTEGERs; only NULL (nothing known) needs mapping
+    total_estimated_exposure_pence = (known_exposure_pence or 0) + (estimated_missing_exposure_pence or 0)
 
-        estimated_missing_exposure_pence = None
-        if missing_value_count > 0 and median_gross_pence is not None:
-            estimated_missing_exposure_pence = int(float(median_gross_pence)) * missing_value_count
+    ready_exposure_pence = _sum_or_none(g["gross_sum"] for g in ready_groups)
+    ready_known_exposure_pence = ready_exposure_pence
 
-        total_estimated_exposure_pence = pence_or_zero(known_exposure_pence) + pence_or_zero(
-            estimated_missing_exposure_pence
-        )
+    manual_known_exposure_pence = _sum_or_none(g["gross_sum"] for g in manual_groups)
 
-        ready_exposure_pence = scalar(
-            conn,
-            f"""
-            SELECT SUM(gross_total)
-            FROM inbox_invoice
-            WHERE is_currently_present = 1
-              AND ({rule.ready_predicate_sql})
-              AND gross_total IS NOT NULL
-              AND gross_total > 0
-            """,
-            rule.ready_params,
-        )
-        ready_known_exposure_pence = ready_exposure_pence
+    manual_value_covered = sum(g["with_value"] for g in manual_groups)
+    manual_missing_value_count = max(manual_count - manual_value_covered, 0)
 
-        manual_known_exposure_pence = scalar(
-            conn,
-            f"""
-            SELECT SUM(gross_total)
-            FROM inbox_invoice
-            WHERE is_currently_present = 1
-              AND ({rule.manual_predicate_sql})
-              AND gross_total IS NOT NULL
-              AND gross_total > 0
-            """,
-            rule.manual_params,
-        )
+    manual_estimated_missing_exposure_pence = None
+    if manual_missing_value_count > 0 and median_gross_pence is not None:
+        manual_estimated_missing_exposure_pence = int(float(median_gross_pence)) * manual_missing_value_count
 
-        manual_value_covered = int(
-            scalar(
-                conn,
-                f"""
-                SELECT SUM(CASE WHEN gross_total IS NOT NULL AND gross_total > 0 THEN 1 ELSE 0 END)
-                FROM inbox_invoice
-                WHERE is_currently_present = 1
-                  AND ({rule.manual_predicate_sql})
-                """,
-                rule.manual_params,
-            )
-            or 0
-        )
-        manual_missing_value_count = max(manual_count - manual_value_covered, 0)
+    manual_total_estimated_exposure_pence = (manual_known_exposure_pence or 0) + (
+        manual_estimated_missing_exposure_pence or 0
+    )
 
-        manual_estimated_missing_exposure_pence = None
-        if manual_missing_value_count > 0 and median_gross_pence is not None:
-            manual_estimated_missing_exposure_pence = int(float(median_gross_pence)) * manual_missing_value_count
+    ocr_needed_count = None
+    if core["has_status"]:
+        ocr_needed_count = sum(g["cnt"] for g in groups if g["status"] == "NO_TEXT_LAYER")
+
+    return {
+        "readiness_source": core["readiness_source"],
+        "total_present": total_present,
+        "ready_count": ready_count,
+        "manual_count": manual_count,
+        "po_confidence": po_confidence,
+        "value_coverage_pct": value_coverage_pct,
+        "last_scan": last_scan,
+        "oldest_days": oldest_days,
+        "known_exposure_pence": known_exposure_pence,
+        "estimated_missing_exposure_pence": estimated_missing_exposure_pence,
+        "total_estimated_exposure_pence": total_estimated_exposure_pence,
+        "median_gross_pence": median_gross_pence,
+        "biggest_invoice_pence": biggest_invoice_pence,
+        "value_covered": value_covered,
+        "missing_value_count": missing_value_count,
+        "ready_exposure_pence": ready_exposure_pence,
+        "ready_known_exposure_pence": ready_known_exposure_pence,
+        "manual_known_exposure_pence": manual_known_exposure_pence,
+        "manual_estimated_missing_exposure_pence": manual_estimated_missing_exposure_pence,
+        "manual_total_estimated_exposure_pence": manual_total_estimated_exposure_pence,
+        "manual_missing_value_count": manual_missing_value_count,
+        "ocr_needed_count": ocr_needed_count,
+    }
+
+
+def load_status_breakdown_data(conn: sqlite3.Connection, core: dict[str, Any] | None = None) -> list[dict[str, Any]]:
+    """
+    Present invoices per po_match_status (count + known gross), derived from
+    the shared core aggregates.
+    """
+    if core is None:
+        core = load_core_aggregates_data(conn)
+    if core is None or not core["has_status"]:
+        return []
+
+    by_status: dict[Any, dict[str, Any]] = {}
+    for g in core["groups"]:
+        row = by_status.setdefault(g["status"], {"status": g["status"], "cnt": 0, "gross_pence": 0})
+        row["cnt"] += g["cnt"]
+        row["gross_pence"] += g["gross_pence"]
+
+    # ORDER BY cnt DESC, status ASC (NULL first, as SQLite sorts it)
+    return sorted(
+        by_status.values(),
+        key=lambda r: (-r["cnt"], r["status"] is not None, r["status"] or ""),
+    )
 
-        manual_total_estimated_exposure_pence = pence_or_zero(manual_known_exposure_pence) + pence_or_zero(
-            manual_estimated_missing_exposure_pence
-        )
 
-        ocr_needed_count = None
-        if "po_match_status" in invoice_cols:
-            ocr_needed_count = int(
-                scalar(
-                    conn,
-                    """
-                    SELECT COUNT(*)
-                    FROM inbox_invoice
-                    WHERE is_currently_present = 1
-                      AND po_match_status = 'NO_TEXT_LAYER'
-                    """,
-                )
-                or 0
-            )
-
-        return {
-            "readiness_source": rule.source,
-            "total_present": total_present,
-            "ready_count": ready_count,
-            "manual_count": manual_count,
-            "po_confidence": po_confidence,
-            "value_coverage_pct": value_coverage_pct,
-            "last_scan": last_scan,
-            "oldest_days": oldest_days,
-            "known_exposure_pence": known_exposure_pence,
-            "estimated_missing_exposure_pence": estimated_missing_exposure_pence,
-            "total_estimated_exposure_pence": total_estimated_exposure_pence,
-            "median_gross_pence": median_gross_pence,
-            "biggest_invoice_pence": biggest_invoice_pence,
-            "value_covered": value_covered,
-            "missing_value_count": missing_value_count,
-            "ready_exposure_pence": ready_exposure_pence,
-            "ready_known_exposure_pence": ready_known_exposure_pence,
-            "manual_known_exposure_pence": manual_known_exposure_pence,
-            "manual_estimated_missing_exposure_pence": manual_estimated_missing_exposure_pence,
-            "manual_total_estimated_exposure_pence": manual_total_estimated_exposure_pence,
-            "manual_missing_value_count": manual_missing_value_count,
-            "ocr_needed_count": ocr_needed_count,
-        }
-
-
-def load_status_breakdown_data(db_path: Path) -> list[dict[str, Any]]:
-    with get_connection(db_path) as conn:
-        if not table_exists(conn, "inbox_invoice"):
-            return []
+def load_ageing_buckets_data(conn: sqlite3.Connection) -> list[dict[str, Any]]:
+    if not table_exists(conn, "inbox_invoice"):
+        return []
+
+    # Prefer the pipeline-materialised cache (first seen stored as a Julian day,
+    # lane precomputed); fall back to the live scan when it has not been built.
+    if table_exists(conn, "invoice_ageing") and scalar(
+        conn, "SELECT EXISTS (SELECT 1 FROM invoice_ageing)"
+    ):
+        base_sql = """
+          SELECT
+            gross_total,
+            lane,
+            CAST((julianday('now') - first_seen_julian) AS INTEGER) AS age_days
+          FROM invoice_ageing
+        """
+        params: tuple = ()
+    else:
         cols = get_table_columns(conn, "inbox_invoice")
-        if "po_match_status" not in cols:
-            return []
-
-        rows = fetch_rows(
-            conn,
-            """
-            SELECT
-                po_match_status AS status,
-                COUNT(*) AS cnt,
-                SUM(CASE WHEN gross_total IS NOT NULL AND gross_total > 0 THEN gross_total ELSE 0 END) AS gross_pence
-            FROM inbox_invoice
-            WHERE is_currently_present = 1
-            GROUP BY po_match_status
-            ORDER BY cnt DESC, status ASC
-            """,
+        rule = build_readiness_rule(cols)
+        base_sql = f"""
+          SELECT
+            gross_total,
+            CASE WHEN ({rule.ready_predicate_sql}) THEN 'Ready' ELSE 'Manual' END AS lane,
+            CAST((julianday('now') - julianday(first_seen_datetime)) AS INTEGER) AS age_days
+          FROM inbox_invoice
+          WHERE is_currently_present = 1
+        """
+        params = rule.ready_params
+
+    rows = fetch_rows(
+        conn,
+        f"""
+        WITH base AS ({base_sql}),
+        bucketed AS (
+          SELECT
+            CASE
+              WHEN age_days <= 1 THEN '0-1 days'
+              WHEN age_days BETWEEN 2 AND 3 THEN '2-3 days'
+              WHEN age_days BETWEEN 4 AND 7 THEN '4-7 days'
+              WHEN age_days BETWEEN 8 AND 14 THEN '8-14 days'
+              ELSE '15+ days'
+            END AS age_bucket,
+            lane,
+            COUNT(*) AS cnt,
+            SUM(CASE WHEN gross_total IS NOT NULL AND gross_total > 0 THEN gross_total ELSE 0 END) AS gross_pence
+          FROM base
+          GROUP BY age_bucket, lane
         )
-        return [dict(r) for r in rows]
+        SELECT age_bucket, lane, cnt, gross_pence
+        FROM bucketed
+        ORDER BY
+          CASE age_bucket
+            WHEN '0-1 days' THEN 1
+            WHEN '2-3 days' THEN 2
+            WHEN '4-7 days' THEN 3
+            WHEN '8-14 days' THEN 4
+            ELSE 5
+          END,
+          lane DESC
+        """,
+        params,
+    )
+    return [dict(r) for r in rows]
 
 
-def load_ageing_buckets_data(db_path: Path) -> list[dict[str, Any]]:
-    with get_connection(db_path) as conn:
-        if not table_exists(conn, "inbox_invoice"):
-            return []
-        cols = get_table_columns(conn, "inbox_invoice")
-        rule = build_readiness_rule(cols)
+def worklist_query(
+    conn: sqlite3.Connection,
+    *,
+    next_action: str | None = None,
+    action_reason: str | None = None,
+    domain_substr: str | None = None,
+) -> tuple[str, tuple] | None:
+    """
+    Build the worklist SELECT (+ params) for the current schema.
 
-        rows = fetch_rows(
-            conn,
-            f"""
-            WITH base AS (
-              SELECT
-                first_seen_datetime,
-                gross_total,
-                CASE WHEN ({rule.ready_predicate_sql}) THEN 1 ELSE 0 END AS is_ready,
-                CAST((julianday('now') - julianday(first_seen_datetime)) AS INTEGER) AS age_days
-              FROM inbox_invoice
-              WHERE is_currently_present = 1
-            ),
-            bucketed AS (
-              SELECT
-                CASE
-                  WHEN age_days <= 1 THEN '0-1 days'
-                  WHEN age_days BETWEEN 2 AND 3 THEN '2-3 days'
-                  WHEN age_days BETWEEN 4 AND 7 THEN '4-7 days'
-                  WHEN age_days BETWEEN 8 AND 14 THEN '8-14 days'
-                  ELSE '15+ days'
-                END AS age_bucket,
-                CASE WHEN is_ready = 1 THEN 'Ready' ELSE 'Manual' END AS lane,
-                COUNT(*) AS cnt,
-                SUM(CASE WHEN gross_total IS NOT NULL AND gross_total > 0 THEN gross_total ELSE 0 END) AS gross_pence
-              FROM base
-              GROUP BY age_bucket, lane
-            )
-            SELECT age_bucket, lane, cnt, gross_pence
-            FROM bucketed
-            ORDER BY
-              CASE age_bucket
-                WHEN '0-1 days' THEN 1
-                WHEN '2-3 days' THEN 2
-                WHEN '4-7 days' THEN 3
-                WHEN '8-14 days' THEN 4
-                ELSE 5
-              END,
-              lane DESC
-            """,
-            rule.ready_params,
-        )
-        return [dict(r) for r in rows]
+    Returns None when no rows can match (missing table, or a domain filter
+    against a worklist without identity columns).
+
+    Optional filters are applied in SQL so only displayed rows are fetched:
+    - next_action / action_reason: exact match
+    - domain_substr: case-insensitive substring of sender_domain
+    """
+    if not table_exists(conn, "invoice_worklist"):
+        return None
 
+    wl_cols = get_table_columns(conn, "invoice_worklist")
+
+    has_identity = all(
+        c in wl_cols for c in ("sender_domain", "email_subject", "attachment_name", "received_datetime")
+    )
+
+    identity_sql = (
+        """
+          wl.sender_domain,
+          wl.email_subject,
+          wl.attachment_name,
+          wl.received_datetime,"""
+        if has_identity
+        else ""
+    )
+
+    where: list[str] = []
+    params: list[Any] = []
+    if next_action is not None:
+        where.append("wl.next_action = ?")
+        params.append(next_action)
+    if action_reason is not None:
+        where.append("wl.action_reason = ?")
+        params.append(action_reason)
+    if domain_substr:
+        if not has_identity:
+            return None
+        where.append("instr(lower(wl.sender_domain), ?) > 0")
+        params.append(domain_substr.lower())
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    # Queue order: priority, then newest first (received_datetime is ISO8601
+    # text, so it sorts lexicographically), hash as the deterministic tiebreak
+    order_sql = (
+        "wl.priority ASC, wl.received_datetime DESC, wl.document_hash ASC"
+        if has_identity
+        else "wl.priority ASC, wl.document_hash ASC"
+    )
 
-def load_worklist_data(db_path: Path) -> list[dict[str, Any]]:
+    sql = f"""
+        SELECT
+          wl.document_hash,{identity_sql}
+          wl.next_action,
+          wl.action_reason,
+          wl.priority,
+          wl.generated_at_utc,
+          wl.is_currently_present,
+          ii.gross_total AS gross_pence
+        FROM invoice_worklist wl
+        LEFT JOIN inbox_invoice ii
+          ON ii.document_hash = wl.document_hash
+        {where_sql}
+        ORDER BY {order_sql}
+        """
+    return sql, tuple(params)
+
+
+def load_worklist_data(
+    conn: sqlite3.Connection,
+    *,
+    next_action: str | None = None,
+    action_reason: str | None = None,
+    domain_substr: str | None = None,
+) -> list[dict[str, Any]]:
     """
     Reads the operational worklist from SQLite and returns rows suitable
     for the dashboard + snapshot.json.
@@ -406,72 +487,63 @@ def load_worklist_data(db_path: Path) -> list[dict[str, Any]]:
     Includes:
     - Outlook identifiers (best effort)
     - gross_pence (joined from inbox_invoice.gross_total) for sorting/display
+
+    Filters: see worklist_query().
     """
-    with get_connection(db_path) as conn:
-        if not table_exists(conn, "invoice_worklist"):
-            return []
+    query = worklist_query(
+        conn,
+        next_action=next_action,
+        action_reason=action_reason,
+        domain_substr=domain_substr,
+    )
+    if query is None:
+        return []
 
-        wl_cols = get_table_columns(conn, "invoice_worklist")
+    sql, params = query
+    cur = _tuple_cursor(conn, sql, params)
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, row)) for row in cur]
 
-        has_identity = all(
-            c in wl_cols for c in ("sender_domain", "email_subject", "attachment_name", "received_datetime")
-        )
 
-        if has_identity:
-            rows = fetch_rows(
-                conn,
-                """
-                SELECT
-                  wl.document_hash,
-                  wl.sender_domain,
-                  wl.email_subject,
-                  wl.attachment_name,
-                  wl.received_datetime,
-                  wl.next_action,
-                  wl.action_reason,
-                  wl.priority,
-                  wl.generated_at_utc,
-                  wl.is_currently_present,
-                  ii.gross_total AS gross_pence
-                FROM invoice_worklist wl
-                LEFT JOIN inbox_invoice ii
-                  ON ii.document_hash = wl.document_hash
-                ORDER BY wl.priority ASC, wl.document_hash ASC
-                """,
-            )
-        else:
-            rows = fetch_rows(
-                conn,
-                """
-                SELECT
-                  wl.document_hash,
-                  wl.next_action,
-                  wl.action_reason,
-                  wl.priority,
-                  wl.generated_at_utc,
-                  wl.is_currently_present,
-                  ii.gross_total AS gross_pence
-                FROM invoice_worklist wl
-                LEFT JOIN inbox_invoice ii
-                  ON ii.document_hash = wl.document_hash
-                ORDER BY wl.priority ASC, wl.document_hash ASC
-                """,
-            )
-
-        return [dict(r) for r in rows]
-
-
-def load_trends_data(db_path: Path) -> list[dict[str, Any]]:
-    with get_connection(db_path) as conn:
-        if not table_exists(conn, "inbox_snapshot_daily"):
-            return []
-        rows = fetch_rows(
-            conn,
-            """
-            SELECT *
-            FROM inbox_snapshot_daily
-            ORDER BY snapshot_date DESC
-            LIMIT 60
-            """,
-        )
-        return [dict(r) for r in rows]
+def load_worklist_filter_options_data(conn: sqlite3.Connection) -> dict[str, Any]:
+    """
+    Filter choices for the worklist UI, without fetching the worklist itself.
+
+    Returns total row count plus the distinct non-blank next_action /
+    action_reason values (sorted), all from one GROUP BY scan.
+    """
+    if not table_exists(conn, "invoice_worklist"):
+        return {"total": 0, "next_actions": [], "action_reasons": []}
+
+    rows = fetch_rows(
+        conn,
+        """
+        SELECT next_action, action_reason, COUNT(*) AS cnt
+        FROM invoice_worklist
+        GROUP BY next_action, action_reason
+        """,
+    )
+
+    def _choices(col: str) -> list[str]:
+        return sorted({r[col] for r in rows if r[col] is not None and str(r[col]).strip()})
+
+    return {
+        "total": sum(r["cnt"] for r in rows),
+        "next_actions": _choices("next_action"),
+        "action_reasons": _choices("action_reason"),
+    }
+
+
+def load_trends_data(conn: sqlite3.Connection) -> list[dict[str, Any]]:
+    if not table_exists(conn, "inbox_snapshot_daily"):
+        return []
+    rows = fetch_rows(
+        conn,
+        """
+        SELECT *
+        FROM inbox_snapshot_daily
+        ORDER BY snapshot_date DESC
+        LIMIT 60
+        """,
+    )
+    return [dict(r) for r in rows]
@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import os
 import sqlite3
+import weakref
+from functools import lru_cache
 from pathlib import Path
 
 """
@@ -15,39 +17,150 @@ db.py (public-safe)
 Public demo convention:
 - DB path can be overridden with ICS_DB_PATH
 - Default DB is ./inbox.db (repo root)
+- Journal mode can be overridden with ICS_SQLITE_JOURNAL (default WAL)
+- Page cache size can be overridden with ICS_SQLITE_CACHE_MB (default 64)
 """
 
 BASE_DIR = Path(__file__).resolve().parent
 
 
+@lru_cache(maxsize=1)
 def _resolve_db_path() -> Path:
     raw = os.getenv("ICS_DB_PATH", "").strip()
     return Path(raw) if raw else (BASE_DIR / "inbox.db")
 
 
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+
+# These modes are stored in the database file, so one switch per file is
+# enough; MEMORY/OFF are per-connection and are applied on every open. Files
+# are keyed by (st_dev, st_ino), not path, and an empty (just created) file is
+# never taken as switched, so a DB deleted and re-created at the same path in
+# a long-lived process gets switched again even if its inode is reused.
+_PERSISTENT_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "WAL"}
+_journal_applied: set[tuple[int, int]] = set()
+
+
+def _db_file_id(db_path: Path) -> tuple[int, int] | None:
+    try:
+        stat = db_path.stat()
+    except OSError:
+        return None
+    if stat.st_size == 0:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+@lru_cache(maxsize=1)
+def _journal_mode() -> str:
+    raw = os.getenv("ICS_SQLITE_JOURNAL", "").strip().upper()
+    return raw if raw in _JOURNAL_MODES else "WAL"
+
+
+@lru_cache(maxsize=1)
+def _cache_size_kib() -> int:
+    raw = os.getenv("ICS_SQLITE_CACHE_MB", "").strip()
+    try:
+        mb = int(raw) if raw else 64
+    except ValueError:
+        mb = 64
+    return max(mb, 1) * 1024
+
+
+def reset_config_cache() -> None:
+    """
+    Re-read ICS_DB_PATH / ICS_SQLITE_* on the next connection (env is read
+    once and memoised; call this after changing them in-process, e.g. tests).
+    """
+    _resolve_db_path.cache_clear()
+    _journal_mode.cache_clear()
+    _cache_size_kib.cache_clear()
+    _journal_applied.clear()
+
+
 def get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(_resolve_db_path())
+    # isolation_level=None: the driver never opens transactions implicitly.
+    # Writers say BEGIN IMMEDIATE themselves, taking the write lock up front
+    # instead of upgrading a deferred read lock (which can fail BUSY under WAL).
+    db_path = _resolve_db_path()
+    conn = sqlite3.connect(db_path, isolation_level=None, factory=SchemaCachedConnection)
     conn.row_factory = sqlite3.Row
+
+    # WAL: readers (dashboard) never block the pipeline's writer, and with
+    # synchronous=NORMAL commits append to the WAL without an fsync each time
+    # (still durable across application crashes; checkpoints fsync).
+    journal_mode = _journal_mode()
+    file_id = _db_file_id(db_path)
+    if journal_mode not in _PERSISTENT_JOURNAL_MODES or file_id is None or file_id not in _journal_applied:
+        conn.execute(f"PRAGMA journal_mode = {journal_mode};")
+        if file_id is not None:
+            _journal_applied.add(file_id)
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute(f"PRAGMA cache_size = -{_cache_size_kib()};")
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
     return conn
 
 
 # ---------------------------------------------------------------------------
 # Schema helpers
 # ---------------------------------------------------------------------------
+# Table -> column names, cached per connection together with the
+# schema_version it was read at. Any DDL (including a migration's ALTER TABLE)
+# bumps schema_version, so a stale entry is simply re-read; unchanged schemas
+# are read once per connection, not per check. Keyed on the connection object
+# itself: file paths are not unique (every :memory: DB reports '', and a file
+# replaced at the same path is a different database).
+class SchemaCachedConnection(sqlite3.Connection):
+    """sqlite3.Connection that can be weakly referenced (plain ones cannot)."""
+
+
+_SCHEMA_CACHE: weakref.WeakKeyDictionary[sqlite3.Connection, tuple[int, dict[str, frozenset[str]]]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def schema_columns(conn: sqlite3.Connection) -> dict[str, frozenset[str]]:
+    """
+    {table name: column names} for conn's main database. Cached only for
+    SchemaCachedConnection handles; any other connection is read every call.
+    """
+    schema_version = conn.execute("PRAGMA schema_version;").fetchone()[0]
+
+    try:
+        cached = _SCHEMA_CACHE.get(conn)
+    except TypeError:  # not weak-referenceable: no caching
+        cached = None
+    if cached is not None and cached[0] == schema_version:
+        return cached[1]
+
+    cols: dict[str, set[str]] = {}
+    for table_name, column_name in conn.execute(
+        """
+        SELECT m.name, p.name
+        FROM sqlite_master m
+        JOIN pragma_table_info(m.name) p
+        WHERE m.type = 'table'
+        """
+    ):
+        cols.setdefault(table_name, set()).add(column_name)
+    schema = {t: frozenset(c) for t, c in cols.items()}
+
+    try:
+        _SCHEMA_CACHE[conn] = (schema_version, schema)
+    except TypeError:
+        pass
+    return schema
+
+
 def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
-    row = conn.execute(
-        "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ? LIMIT 1;",
-        (name,),
-    ).fetchone()
-    return row is not None
+    return name in schema_columns(conn)
 
 
 def _column_exists(conn: sqlite3.Connection, table: str, column: str) -> bool:
-    if not _table_exists(conn, table):
-        return False
-    rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
-    return any(r["name"] == column for r in rows)
+    return column in schema_columns(conn).get(table, ())
 
 
 # ---------------------------------------------------------------------------
@@ -69,27 +182,42 @@ def _migrate_add_ready_to_post(conn: sqlite3.Connection) -> None:
     if not _column_exists(conn, "inbox_invoice", "ready_to_post"):
         conn.execute("ALTER TABLE inbox_invoice ADD COLUMN ready_to_post INTEGER;")
 
-    # Backfill once (only NULL), based on canonical validation truth
+    # Partial index over exactly the rows the UPDATE below targets, built for
+    # the backfill and dropped straight after: new rows are inserted with
+    # ready_to_post NULL and only some are ever set, so keeping it would tax
+    # every scan insert/update on inbox_invoice.
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_invoice_ready_unset
+        ON inbox_invoice (ready_to_post)
+        WHERE ready_to_post IS NULL OR ready_to_post NOT IN (0,1);
+        """
+    )
+
+    # Single pass over the rows that need it:
+    # - backfill once (only NULL), based on canonical validation truth
+    # - defensive normalisation (anything other than 0/1 becomes 0)
     if _column_exists(conn, "inbox_invoice", "po_validation_status"):
         conn.execute(
             """
             UPDATE inbox_invoice
             SET ready_to_post = CASE
-                WHEN po_validation_status = 'VALID_PO' THEN 1
+                WHEN ready_to_post IS NULL AND po_validation_status = 'VALID_PO' THEN 1
                 ELSE 0
             END
-            WHERE ready_to_post IS NULL
+            WHERE ready_to_post IS NULL OR ready_to_post NOT IN (0,1)
+            """
+        )
+    else:
+        conn.execute(
+            """
+            UPDATE inbox_invoice
+            SET ready_to_post = 0
+            WHERE ready_to_post IS NOT NULL AND ready_to_post NOT IN (0,1)
             """
         )
 
-    # Defensive normalisation
-    conn.execute(
-        """
-        UPDATE inbox_invoice
-        SET ready_to_post = 0
-        WHERE ready_to_post IS NOT NULL AND ready_to_post NOT IN (0,1)
-        """
-    )
+    conn.execute("DROP INDEX IF EXISTS idx_invoice_ready_unset;")
 
 
 def _migrate_add_po_master_approval_status(conn: sqlite3.Connection) -> None:
@@ -118,6 +246,89 @@ def _migrate_add_worklist_identity_columns(conn: sqlite3.Connection) -> None:
                 conn.execute(f"ALTER TABLE invoice_worklist_history ADD COLUMN {col} {col_type};")
 
 
+def _migrate_worklist_history_without_rowid(conn: sqlite3.Connection) -> None:
+    # Older DBs: rowid table with an AUTOINCREMENT id + three indexes -> rebuild
+    # as WITHOUT ROWID on (run_id, document_hash). Runs after the identity
+    # column migration so every column exists on the old table.
+    if not _column_exists(conn, "invoice_worklist_history", "id"):
+        return
+
+    cols = """
+        run_id,
+        document_hash,
+        sender_domain,
+        email_subject,
+        attachment_name,
+        received_datetime,
+        next_action,
+        action_reason,
+        priority,
+        generated_at_utc,
+        is_currently_present
+    """
+    conn.execute("DROP TABLE IF EXISTS invoice_worklist_history__new;")
+    conn.execute(
+        """
+        CREATE TABLE invoice_worklist_history__new (
+            run_id TEXT NOT NULL,
+            document_hash TEXT NOT NULL,
+
+            sender_domain TEXT,
+            email_subject TEXT,
+            attachment_name TEXT,
+            received_datetime TEXT,
+
+            next_action TEXT NOT NULL,
+            action_reason TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            generated_at_utc TEXT NOT NULL,
+            is_currently_present INTEGER NOT NULL CHECK (is_currently_present IN (0,1)),
+
+            PRIMARY KEY (run_id, document_hash),
+            FOREIGN KEY (document_hash) REFERENCES inbox_invoice(document_hash)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT OR IGNORE INTO invoice_worklist_history__new ({cols})
+        SELECT {cols}
+        FROM invoice_worklist_history
+        ORDER BY id;
+        """
+    )
+    # Last chance to read the old run order: register runs by their first id
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO invoice_worklist_run (run_id, generated_at_utc)
+        SELECT run_id, MIN(generated_at_utc)
+        FROM invoice_worklist_history
+        GROUP BY run_id
+        ORDER BY MIN(id);
+        """
+    )
+    conn.execute("DROP TABLE invoice_worklist_history;")
+    conn.execute("ALTER TABLE invoice_worklist_history__new RENAME TO invoice_worklist_history;")
+
+
+def _migrate_backfill_worklist_runs(conn: sqlite3.Connection) -> None:
+    # Histories written before invoice_worklist_run existed: register their runs
+    # once, in generated_at_utc order (ties within a second fall back to run_id)
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM invoice_worklist_run);").fetchone()[0]:
+        return
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO invoice_worklist_run (run_id, generated_at_utc)
+        SELECT run_id, MIN(generated_at_utc)
+        FROM invoice_worklist_history
+        GROUP BY run_id
+        ORDER BY MIN(generated_at_utc), run_id;
+        """
+    )
+
+
 def _ensure_indexes(conn: sqlite3.Connection) -> None:
     # Safe indexes that only reference columns guaranteed by base schema or migrations
     conn.execute(
@@ -135,27 +346,88 @@ def _ensure_indexes(conn: sqlite3.Connection) -> None:
     conn.execute("CREATE INDEX IF NOT EXISTS idx_invoice_supplier_status ON inbox_invoice (supplier_account_expected, supplier_validation_status);")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_invoice_posting ON inbox_invoice (processing_status, posted_datetime);")
 
+    # Dashboard read paths: every metric filters on presence, then groups/orders by these
+    # (is_currently_present, po_match_status) prefix also serves the dashboard; the
+    # trailing po_validation_status backs the worklist classification ladder
+    conn.execute("DROP INDEX IF EXISTS idx_invoice_present_status;")
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_invoice_present_match_validation
+        ON inbox_invoice (is_currently_present, po_match_status, po_validation_status);
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoice_present_gross ON inbox_invoice (is_currently_present, gross_total);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoice_present_first_seen ON inbox_invoice (is_currently_present, first_seen_datetime);")
+
+    # PO validation: every statement filters present + unposted + po_match_status.
+    # invoice_po(document_hash) and po_master(po_number) lookups are already served
+    # by their primary keys, so no extra indexes there.
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_invoice_unposted_status
+        ON inbox_invoice (is_currently_present, po_match_status)
+        WHERE posted_datetime IS NULL;
+        """
+    )
+
+    # PO detection work queue: exactly the rows run_po_detection selects (keep the
+    # predicate in step with its query), already in its ORDER BY. Once every
+    # invoice is scanned the index is empty and the candidate query costs nothing.
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_invoice_po_unscanned
+        ON inbox_invoice (document_hash)
+        WHERE is_currently_present = 1
+          AND (po_match_status IS NULL OR po_match_status = 'UNSCANNED');
+        """
+    )
+
+    # Worklist refresh: covers every inbox_invoice column the classification SELECT
+    # reads, so the present-row scan never touches the table itself. The
+    # inbox_message side is a lookup on its message_id primary key.
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_invoice_worklist_cover
+        ON inbox_invoice (
+            is_currently_present,
+            document_hash,
+            message_id,
+            po_match_status,
+            po_validation_status,
+            ready_to_post,
+            gross_total,
+            attachment_file_name
+        );
+        """
+    )
+
     conn.execute("CREATE INDEX IF NOT EXISTS idx_invoice_po_po ON invoice_po (po_number);")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_po_supplier ON po_master (supplier_account);")
 
     conn.execute("CREATE INDEX IF NOT EXISTS idx_worklist_action ON invoice_worklist (next_action, priority);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_worklist_present ON invoice_worklist (is_currently_present, priority);")
-
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_worklist_hist_run ON invoice_worklist_history (run_id);")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_worklist_hist_doc ON invoice_worklist_history (document_hash);")
+    # Partial: readers only ever ask for present rows, so absent rows stay out of the B-tree
+    conn.execute("DROP INDEX IF EXISTS idx_worklist_present;")
     conn.execute(
         """
-        CREATE UNIQUE INDEX IF NOT EXISTS uq_worklist_hist_run_doc
-        ON invoice_worklist_history (run_id, document_hash);
+        CREATE INDEX IF NOT EXISTS idx_worklist_present_live
+        ON invoice_worklist (priority)
+        WHERE is_currently_present = 1;
         """
     )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_worklist_priority_hash ON invoice_worklist (priority, document_hash);")
+
+    # invoice_worklist_history needs no secondary indexes: its (run_id, document_hash)
+    # primary key covers the run lookups (_migrate_worklist_history_without_rowid
+    # drops the old idx_worklist_hist_* / uq_worklist_hist_run_doc with the old table)
 
-    # Ready index only if column exists
+    # Ready index only if column exists (partial, as above)
     if _column_exists(conn, "inbox_invoice", "ready_to_post"):
+        conn.execute("DROP INDEX IF EXISTS idx_invoice_ready_present;")
         conn.execute(
             """
-            CREATE INDEX IF NOT EXISTS idx_invoice_ready_present
-            ON inbox_invoice (is_currently_present, ready_to_post);
+            CREATE INDEX IF NOT EXISTS idx_invoice_ready_present_live
+            ON inbox_invoice (ready_to_post)
+            WHERE is_currently_present = 1;
             """
         )
 
@@ -310,8 +582,9 @@ def initialise_database() -> None:
                 ON DELETE CASCADE
         );
 
+        -- Keyed on (run_id, document_hash): the clustered primary key is the
+        -- per-run uniqueness rule and serves run lookups with no extra index
         CREATE TABLE IF NOT EXISTS invoice_worklist_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
             run_id TEXT NOT NULL,
             document_hash TEXT NOT NULL,
 
@@ -326,6 +599,31 @@ def initialise_database() -> None:
             generated_at_utc TEXT NOT NULL,
             is_currently_present INTEGER NOT NULL CHECK (is_currently_present IN (0,1)),
 
+            PRIMARY KEY (run_id, document_hash),
+            FOREIGN KEY (document_hash) REFERENCES inbox_invoice(document_hash)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        ) WITHOUT ROWID;
+
+        -- One row per worklist refresh. run_seq orders the runs:
+        -- generated_at_utc has one-second resolution, so runs can tie on it
+        CREATE TABLE IF NOT EXISTS invoice_worklist_run (
+            run_seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL UNIQUE,
+            generated_at_utc TEXT NOT NULL
+        );
+
+        -- =========================================================
+        -- Ageing cache (refreshed per pipeline run)
+        -- =========================================================
+        CREATE TABLE IF NOT EXISTS invoice_ageing (
+            document_hash TEXT PRIMARY KEY,
+
+            first_seen_julian REAL,
+            lane TEXT NOT NULL CHECK (lane IN ('Ready','Manual')),
+            gross_total INTEGER,
+            generated_at_utc TEXT NOT NULL,
+
             FOREIGN KEY (document_hash) REFERENCES inbox_invoice(document_hash)
                 ON UPDATE CASCADE
                 ON DELETE CASCADE
@@ -333,17 +631,33 @@ def initialise_database() -> None:
         """
     )
 
-    # Migrations for older DBs (idempotent)
-    _migrate_add_po_master_approval_status(conn)
-    _migrate_add_po_validation_status(conn)
-    _migrate_add_ready_to_post(conn)
-    _migrate_add_worklist_identity_columns(conn)
+    try:
+        # One write transaction for every migration + index: a single commit
+        # instead of one per ALTER/UPDATE/CREATE INDEX
+        conn.execute("BEGIN IMMEDIATE")
 
-    # Indexes (safe, idempotent)
-    _ensure_indexes(conn)
+        # Migrations for older DBs (idempotent)
+        _migrate_add_po_master_approval_status(conn)
+        _migrate_add_po_validation_status(conn)
+        _migrate_add_ready_to_post(conn)
+        _migrate_add_worklist_identity_columns(conn)
+        _migrate_worklist_history_without_rowid(conn)
+        _migrate_backfill_worklist_runs(conn)
 
-    conn.commit()
-    conn.close()
+        # Indexes (safe, idempotent)
+        _ensure_indexes(conn)
+
+        conn.commit()
+
+        # Planner statistics (sqlite_stat1) for new/changed indexes; analysis_limit
+        # keeps this a bounded sample rather than a full scan on large tables
+        conn.execute("PRAGMA analysis_limit = 400;")
+        conn.execute("PRAGMA optimize;")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 
 def reset_database() -> None:
@@ -351,8 +665,10 @@ def reset_database() -> None:
     cur = conn.cursor()
     cur.executescript(
         """
+        DROP TABLE IF EXISTS invoice_worklist_run;
         DROP TABLE IF EXISTS invoice_worklist_history;
         DROP TABLE IF EXISTS invoice_worklist;
+        DROP TABLE IF EXISTS invoice_ageing;
         DROP TABLE IF EXISTS invoice_resolution;
         DROP TABLE IF EXISTS invoice_po;
         DROP TABLE IF EXISTS inbox_invoice;
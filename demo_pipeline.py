@@ -2,9 +2,16 @@ from __future__ import annotations
 
 import json
 import os
+import sqlite3
+from contextlib import closing, nullcontext
 from datetime import datetime, timezone
 from pathlib import Path
 
+try:
+    import orjson  # optional: faster snapshot export (stdlib json otherwise)
+except ImportError:
+    orjson = None
+
 from db import initialise_database, get_connection
 from outlook_scanner import scan_outlook_to_db
 from po_detection import run_po_detection
@@ -14,6 +21,8 @@ from worklist import refresh_worklist_tables
 from load_po_master import load_po_master
 
 from dashboard_data import (
+    get_connection as get_dashboard_connection,
+    load_core_aggregates_data,
     load_overview_data,
     load_status_breakdown_data,
     load_ageing_buckets_data,
@@ -57,27 +66,43 @@ def print_tables() -> None:
     dprint("DB tables:", tables)
 
 
-def write_local_snapshot(*, db_path: Path, out_path: Path, include_trends: bool = False, include_worklist: bool = True) -> None:
+def write_local_snapshot(
+    *,
+    db_path: Path,
+    out_path: Path,
+    include_trends: bool = False,
+    include_worklist: bool = True,
+    conn: sqlite3.Connection | None = None,
+) -> None:
     """
     Public-safe local snapshot export for the dashboard (no networking).
+
+    Reads through `conn` when given (e.g. the pipeline's shared connection),
+    else opens a read-only dashboard connection on db_path.
     """
     now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
-    overview = load_overview_data(db_path)
-    if "_error" in overview:
-        payload = {"generated_at": now, "_error": overview["_error"]}
-    else:
-        payload = {
-            "generated_at": now,
-            "overview": overview,
-            "status_breakdown": load_status_breakdown_data(db_path),
-            "ageing_buckets": load_ageing_buckets_data(db_path),
-            "worklist": load_worklist_data(db_path) if include_worklist else [],
-            "trends": load_trends_data(db_path) if include_trends else [],
-        }
+    with closing(get_dashboard_connection(db_path)) if conn is None else nullcontext(conn) as conn:
+        core = load_core_aggregates_data(conn)
+        overview = load_overview_data(conn, core=core)
+        if "_error" in overview:
+            payload = {"generated_at": now, "_error": overview["_error"]}
+        else:
+            payload = {
+                "generated_at": now,
+                "overview": overview,
+                "status_breakdown": load_status_breakdown_data(conn, core=core),
+                "ageing_buckets": load_ageing_buckets_data(conn),
+                "worklist": load_worklist_data(conn) if include_worklist else [],
+                "trends": load_trends_data(conn) if include_trends else [],
+            }
 
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    if orjson is not None:
+        # UTF-8 bytes straight from the C encoder (no intermediate str)
+        out_path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        out_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
 def _assert_demo_inputs_exist() -> None:
@@ -134,14 +159,21 @@ def run_pipeline() -> dict:
     initialise_database()
     print_tables()
 
+    # One connection for every stage: keeps the page cache warm across stages
+    # (each stage still runs and commits its own transaction)
+    with closing(get_connection()) as conn:
+        return _run_stages(conn, boot_ts=boot_ts)
+
+
+def _run_stages(conn: sqlite3.Connection, *, boot_ts: str) -> dict:
     # 2) Load synthetic PO master
     print("\n--- Stage 1: PO Master Load ---")
-    po_master_summary = load_po_master(PO_MASTER_CSV)
+    po_master_summary = load_po_master(PO_MASTER_CSV, conn=conn)
     print(po_master_summary)
 
     # 3) Scan inbox -> SQLite (demo adapter)
     print("\n--- Stage 2: Inbox Scan ---", flush=True)
-    scan_summary = scan_outlook_to_db()
+    scan_summary = scan_outlook_to_db(conn=conn)
     print(
         {
             "messages_seen": scan_summary.get("messages_seen"),
@@ -156,31 +188,28 @@ def run_pipeline() -> dict:
 
     # 4) PO Detection
     print("\n--- Stage 3: PO Detection ---")
-    po_detect_summary = run_po_detection(staging_dir=STAGING_DIR)
+    po_detect_summary = run_po_detection(staging_dir=STAGING_DIR, conn=conn)
     print(po_detect_summary)
 
     # 5) PO Validation
     print("\n--- Stage 4: PO Validation ---")
-    po_validation_summary = run_po_validation()
+    po_validation_summary = run_po_validation(conn=conn)
     print(po_validation_summary)
 
     # 6) Value Extraction
     print("\n--- Stage 5: Value Extraction ---")
-    value_summary = run_value_extraction(staging_dir=STAGING_DIR)
+    value_summary = run_value_extraction(staging_dir=STAGING_DIR, conn=conn)
     print(value_summary)
 
     # 7) Worklist refresh
     print("\n--- Stage 6: Worklist Refresh ---")
-    conn = get_connection()
-    try:
-        run_id = refresh_worklist_tables(conn)
-    finally:
-        conn.close()
+    # (invoice_ageing is refreshed by the scan/validation/value stages themselves)
+    run_id = refresh_worklist_tables(conn)
     print(f"Worklist refreshed. run_id={run_id}")
 
     # 8) Snapshot export (local)
     print("\n--- Stage 7: Snapshot Export (local) ---")
-    write_local_snapshot(db_path=DB_PATH, out_path=SNAPSHOT_JSON, include_trends=False, include_worklist=True)
+    write_local_snapshot(db_path=DB_PATH, out_path=SNAPSHOT_JSON, include_trends=False, include_worklist=True, conn=conn)
     print(f"Snapshot written: {SNAPSHOT_JSON}")
 
     print("\n=== Pipeline complete ===")
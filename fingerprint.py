@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import hashlib
+import os
+import shutil
 from pathlib import Path
 
 
@@ -9,8 +11,42 @@ def sha256_file(path: Path) -> str:
     Deterministic document fingerprint.
     Identity rule: same PDF bytes => same hash => same record.
     """
-    h = hashlib.sha256()
     with path.open("rb") as f:
+        # 3.11+: reads into one reusable buffer and hashes via OpenSSL with the GIL released
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+        h = hashlib.sha256()
         for chunk in iter(lambda: f.read(1024 * 1024), b""):
             h.update(chunk)
     return h.hexdigest()
+
+
+def copy_and_hash(src: Path, dst: Path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Copy src to dst and return sha256_file(dst), reading the bytes once.
+    One buffered pass writes and hashes each chunk, instead of a copy
+    followed by a second full read of the copy.
+    """
+    if dst.exists() and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+
+    h = hashlib.sha256()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            h.update(chunk)
+            while chunk:
+                written = fdst.write(chunk)
+                chunk = chunk[written:]
+
+    return h.hexdigest()
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import csv
+import re
+import sqlite3
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -24,7 +26,34 @@ def _pick_field(fieldnames: set[str], candidates: list[str]) -> str | None:
     return None
 
 
-def load_po_master(csv_path: Path) -> dict:
+_STAGING_TABLE = "po_master__new"
+
+
+def _create_staging_table(cur: sqlite3.Cursor) -> list[str]:
+    """
+    Create an empty po_master__new with po_master's current schema (including
+    any columns added by migrations). Returns po_master's index DDL so the
+    indexes can be rebuilt once the staging table is swapped in.
+    """
+    row = cur.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name='po_master';"
+    ).fetchone()
+    if row is None:
+        raise sqlite3.OperationalError("no such table: po_master")
+
+    index_sql = [
+        r[0]
+        for r in cur.execute(
+            "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name='po_master' AND sql IS NOT NULL;"
+        ).fetchall()
+    ]
+
+    cur.execute(f"DROP TABLE IF EXISTS {_STAGING_TABLE};")
+    cur.execute(re.sub(r'^CREATE TABLE\s+("?)po_master\1', f"CREATE TABLE {_STAGING_TABLE}", row[0], count=1))
+    return index_sql
+
+
+def load_po_master(csv_path: Path, *, conn: sqlite3.Connection | None = None) -> dict:
     """
     Load a PO master snapshot into SQLite (public-safe).
 
@@ -35,25 +64,35 @@ def load_po_master(csv_path: Path) -> dict:
        - Purchase order, Supplier account, Purchase order status, Approval status
 
     Behaviour:
-    - Full refresh per run (snapshot semantics)
+    - Full refresh per run (snapshot semantics): rows are built in a staging
+      table that replaces po_master in the same transaction, so the old rows
+      are dropped wholesale rather than deleted one by one
     - Safe to re-run
+    - Uses `conn` when given (caller keeps ownership), else opens its own
     """
     if not csv_path.exists():
         raise FileNotFoundError(f"PO master CSV not found: {csv_path}")
 
     now = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
-    conn = get_connection()
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_connection()
     cur = conn.cursor()
     inserted = 0
 
     try:
-        conn.execute("BEGIN")
-        cur.execute("DELETE FROM po_master")
+        # IMMEDIATE: take the write lock up front rather than escalating from a read lock
+        conn.execute("BEGIN IMMEDIATE")
+        index_sql = _create_staging_table(cur)
 
         with csv_path.open(newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            fieldnames = set(reader.fieldnames or [])
+            # Plain csv.reader + column indices resolved once from the header:
+            # no per-row dict construction or per-field hashing
+            reader = csv.reader(f)
+            header = next(reader, [])
+            header_idx = {name: i for i, name in enumerate(header)}  # last duplicate wins, as DictReader
+            fieldnames = set(header_idx)
 
             # Resolve columns (canonical or export-like)
             col_po = _pick_field(fieldnames, _EXPORT_ALIASES["po_number"])
@@ -68,38 +107,61 @@ def load_po_master(csv_path: Path) -> dict:
                     f"Missing: {missing}. Found headers: {sorted(fieldnames)}"
                 )
 
-            for row in reader:
-                po_number = (row.get(col_po) or "").strip()
-                if not po_number:
-                    continue
-
-                cur.execute(
-                    """
-                    INSERT INTO po_master (
-                        po_number,
-                        supplier_account,
-                        po_status,
-                        approval_status,
-                        last_import_datetime
-                    )
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    (
+            i_po, i_supp, i_status, i_appr = (header_idx[c] for c in (col_po, col_supp, col_status, col_appr))
+            width = max(i_po, i_supp, i_status, i_appr) + 1
+
+            def _rows():
+                for row in reader:
+                    if not row:
+                        continue  # blank line (DictReader skipped these too)
+                    if len(row) < width:
+                        row += [""] * (width - len(row))  # short row: missing fields read as blank
+                    po_number = row[i_po].strip()
+                    if not po_number:
+                        continue
+                    yield (
                         po_number,
-                        (row.get(col_supp) or "").strip(),
-                        (row.get(col_status) or "").strip(),
-                        (row.get(col_appr) or "").strip(),
+                        row[i_supp].strip(),
+                        row[i_status].strip(),
+                        row[i_appr].strip(),
                         now,
-                    ),
+                    )
+
+            # One prepared statement, driven from C over the CSV stream
+            cur.executemany(
+                f"""
+                INSERT INTO {_STAGING_TABLE} (
+                    po_number,
+                    supplier_account,
+                    po_status,
+                    approval_status,
+                    last_import_datetime
                 )
-                inserted += 1
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                _rows(),
+            )
+            inserted = cur.rowcount
+
+        # Publish atomically: DDL is transactional, readers keep the old table until commit
+        cur.execute("DROP TABLE po_master;")
+        cur.execute(f"ALTER TABLE {_STAGING_TABLE} RENAME TO po_master;")
+
+        # Secondary indexes (idx_po_supplier) are built only now, in one sorted
+        # pass over the loaded rows, rather than maintained per INSERT above
+        for sql in index_sql:
+            cur.execute(sql)
 
         conn.commit()
 
+        # Fresh indexes on a wholly replaced table: refresh planner statistics
+        conn.execute("ANALYZE po_master;")
+
     except Exception:
         conn.rollback()
         raise
     finally:
-        conn.close()
+        if owns_conn:
+            conn.close()
 
     return {"rows_loaded": inserted, "source": str(csv_path), "imported_at": now}
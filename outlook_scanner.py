@@ -7,10 +7,11 @@ This module intentionally excludes Outlook/COM integration for the public repo.
 
 What it does:
 - Reads inbox messages from a synthetic JSON feed (data/inbox.json)
-- Copies PDF attachments from data/attachments/ into staging/
+- Copies PDF attachments from data/attachments/ into staging/<document_hash>.pdf
 - Computes document_hash (SHA-256)
 - Persists scan results into SQLite (inbox_message + inbox_invoice)
-- Implements presence reset semantics (begin_scan) per run
+- Implements presence reset semantics (end_scan) per run
+- Refreshes the invoice_ageing cache in the same transaction
 
 What it does NOT do (public version):
 - Access Outlook profiles
@@ -34,14 +35,28 @@ Environment overrides:
 import json
 import os
 import re
-import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from itertools import repeat
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
+try:  # optional: streams inbox.json instead of loading it whole
+    import ijson
+except ImportError:  # pragma: no cover - falls back to a whole-file parse
+    ijson = None
+
+try:
+    import orjson  # optional: faster whole-file parse when ijson is absent
+except ImportError:
+    orjson = None
+
+from ageing import write_ageing_rows
 from db import get_connection, initialise_database
-from fingerprint import sha256_file
+from fingerprint import copy_and_hash
 
 
 # =============================================================================
@@ -124,11 +139,14 @@ def now_iso_utc() -> str:
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
 
+_SAFE_FN_RE = re.compile(r"[^\w\-. ]+")
+
+
 def safe_filename(name: str) -> str:
     """
     Windows-safe, deterministic. Keep extension. Replace weird chars.
     """
-    s = re.sub(r"[^\w\-. ]+", "_", str(name)).strip()
+    s = _SAFE_FN_RE.sub("_", str(name)).strip()
     return s or "attachment.pdf"
 
 
@@ -141,13 +159,23 @@ def short_message_id(message_id: str, n: int = 12) -> str:
 # DB helpers (presence + upserts)
 # =============================================================================
 
-def begin_scan(conn, scan_ts: str) -> None:
+def end_scan(
+    conn,
+    scan_ts: str,
+    *,
+    seen_message_ids: list[str],
+    seen_document_hashes: list[str],
+) -> None:
     """
-    Presence reset for a new scan.
+    Presence reset for a finished scan (run after this scan's upserts).
 
     V1 behaviour:
-    - Mark all currently-present messages/invoices as not present.
-    - Upserts during this scan set is_currently_present back to 1.
+    - Upserts during this scan set is_currently_present = 1 on what was seen.
+    - Every other currently-present message/invoice is marked not present.
+
+    Same end state as resetting everything before the upserts, but only the
+    rows that disappeared are written, not every present row twice. Seen keys
+    travel as one JSON parameter each.
     """
     cur = conn.cursor()
 
@@ -158,8 +186,9 @@ def begin_scan(conn, scan_ts: str) -> None:
         SET is_currently_present = 0,
             last_scan_datetime = ?
         WHERE is_currently_present = 1
+          AND message_id NOT IN (SELECT value FROM json_each(?))
         """,
-        (scan_ts,),
+        (scan_ts, json.dumps(seen_message_ids)),
     )
 
     # Invoices (exclude posted invoices)
@@ -170,13 +199,75 @@ def begin_scan(conn, scan_ts: str) -> None:
             last_scan_datetime = ?
         WHERE is_currently_present = 1
           AND posted_datetime IS NULL
+          AND document_hash NOT IN (SELECT value FROM json_each(?))
         """,
-        (scan_ts,),
+        (scan_ts, json.dumps(seen_document_hashes)),
     )
 
 
-def upsert_message(
-    conn,
+_UPSERT_MESSAGE_SQL = """
+    INSERT INTO inbox_message (
+        message_id,
+        current_location,
+        first_seen_datetime,
+        last_seen_datetime,
+        last_scan_datetime,
+        is_currently_present,
+        received_datetime,
+        sender_address,
+        subject,
+        has_attachments,
+        attachment_count
+    )
+    VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+    ON CONFLICT(message_id) DO UPDATE SET
+        current_location      = excluded.current_location,
+        last_seen_datetime    = excluded.last_seen_datetime,
+        last_scan_datetime    = excluded.last_scan_datetime,
+        is_currently_present  = 1,
+        received_datetime     = excluded.received_datetime,
+        sender_address        = excluded.sender_address,
+        subject               = excluded.subject,
+        has_attachments       = excluded.has_attachments,
+        attachment_count      = excluded.attachment_count
+"""
+
+_UPSERT_INVOICE_SQL = """
+    INSERT INTO inbox_invoice (
+        document_hash,
+        message_id,
+        attachment_file_name,
+        first_seen_datetime,
+        last_seen_datetime,
+        last_scan_datetime,
+        is_currently_present,
+        source_folder_path,
+        po_count,
+        po_match_status,
+        supplier_account_expected,
+        supplier_validation_status,
+        processing_status,
+        posted_datetime,
+        net_total,
+        vat_total,
+        gross_total,
+        review_outcome,
+        reviewed_datetime,
+        reviewed_by,
+        review_note
+    )
+    VALUES (?, ?, ?, ?, ?, ?, 1, ?, 0, 'UNSCANNED', NULL, NULL, 'NEW', NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL)
+    ON CONFLICT(document_hash) DO UPDATE SET
+        message_id            = excluded.message_id,
+        attachment_file_name  = excluded.attachment_file_name,
+        last_seen_datetime    = excluded.last_seen_datetime,
+        last_scan_datetime    = excluded.last_scan_datetime,
+        is_currently_present  = 1,
+        source_folder_path    = excluded.source_folder_path
+"""
+
+
+def _message_row(
     *,
     message_id: str,
     current_location: str,
@@ -186,114 +277,77 @@ def upsert_message(
     subject: Optional[str],
     has_attachments: bool,
     attachment_count: int,
-) -> None:
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO inbox_message (
-            message_id,
-            current_location,
-            first_seen_datetime,
-            last_seen_datetime,
-            last_scan_datetime,
-            is_currently_present,
-            received_datetime,
-            sender_address,
-            subject,
-            has_attachments,
-            attachment_count
-        )
-        VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
-        ON CONFLICT(message_id) DO UPDATE SET
-            current_location      = excluded.current_location,
-            last_seen_datetime    = excluded.last_seen_datetime,
-            last_scan_datetime    = excluded.last_scan_datetime,
-            is_currently_present  = 1,
-            received_datetime     = excluded.received_datetime,
-            sender_address        = excluded.sender_address,
-            subject               = excluded.subject,
-            has_attachments       = excluded.has_attachments,
-            attachment_count      = excluded.attachment_count
-        """,
-        (
-            message_id,
-            current_location,
-            scan_ts,  # first_seen on insert
-            scan_ts,  # last_seen
-            scan_ts,  # last_scan
-            received_datetime,
-            sender_address,
-            subject,
-            1 if has_attachments else 0,
-            int(attachment_count),
-        ),
+) -> tuple:
+    return (
+        message_id,
+        current_location,
+        scan_ts,  # first_seen on insert
+        scan_ts,  # last_seen
+        scan_ts,  # last_scan
+        received_datetime,
+        sender_address,
+        subject,
+        has_attachments,  # bool is an int subclass: sqlite3 binds it as 1/0
+        attachment_count,
     )
 
 
-def upsert_invoice(
-    conn,
+def _invoice_row(
     *,
     document_hash: str,
     message_id: str,
     attachment_file_name: str,
     scan_ts: str,
     source_folder_path: str,
-) -> None:
+) -> tuple:
+    return (
+        document_hash,
+        message_id,
+        attachment_file_name,
+        scan_ts,
+        scan_ts,
+        scan_ts,
+        source_folder_path,
+    )
+
+
+def upsert_message(conn, *, cur: Optional[sqlite3.Cursor] = None, **fields) -> None:
+    """
+    Upsert one inbox_message row (see _message_row for the fields).
+    Pass `cur` to reuse one cursor across many calls.
+    """
+    (cur or conn.cursor()).execute(_UPSERT_MESSAGE_SQL, _message_row(**fields))
+
+
+def upsert_invoice(conn, *, cur: Optional[sqlite3.Cursor] = None, **fields) -> None:
     """
     Upsert into inbox_invoice (presence + linkage + timestamps only).
     Other truth columns are handled by later pipeline stages.
+    Pass `cur` to reuse one cursor across many calls.
     """
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO inbox_invoice (
-            document_hash,
-            message_id,
-            attachment_file_name,
-            first_seen_datetime,
-            last_seen_datetime,
-            last_scan_datetime,
-            is_currently_present,
-            source_folder_path,
-            po_count,
-            po_match_status,
-            supplier_account_expected,
-            supplier_validation_status,
-            processing_status,
-            posted_datetime,
-            net_total,
-            vat_total,
-            gross_total,
-            review_outcome,
-            reviewed_datetime,
-            reviewed_by,
-            review_note
-        )
-        VALUES (?, ?, ?, ?, ?, ?, 1, ?, 0, 'UNSCANNED', NULL, NULL, 'NEW', NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL)
-        ON CONFLICT(document_hash) DO UPDATE SET
-            message_id            = excluded.message_id,
-            attachment_file_name  = excluded.attachment_file_name,
-            last_seen_datetime    = excluded.last_seen_datetime,
-            last_scan_datetime    = excluded.last_scan_datetime,
-            is_currently_present  = 1,
-            source_folder_path    = excluded.source_folder_path
-        """,
-        (
-            document_hash,
-            message_id,
-            attachment_file_name,
-            scan_ts,
-            scan_ts,
-            scan_ts,
-            source_folder_path,
-        ),
-    )
+    (cur or conn.cursor()).execute(_UPSERT_INVOICE_SQL, _invoice_row(**fields))
 
 
 # =============================================================================
 # JSON adapter (data/inbox.json)
 # =============================================================================
 
+def _iter_json_array(path: Path) -> Iterator[dict]:
+    """
+    Yield items of a top-level JSON array, streamed with ijson when installed
+    (else parsed whole, with orjson when installed).
+    """
+    if ijson is None:
+        if orjson is not None:
+            yield from orjson.loads(path.read_bytes())
+        else:
+            yield from json.loads(path.read_text(encoding="utf-8"))
+        return
+
+    with path.open("rb") as fh:
+        yield from ijson.items(fh, "item")
+
+
 def _load_json_messages(
     inbox_json_path: Path,
     attachments_dir: Path,
@@ -329,16 +383,31 @@ def _load_json_messages(
             f"Create {attachments_dir} or set ICS_ATTACHMENTS_DIR."
         )
 
-    raw = json.loads(inbox_json_path.read_text(encoding="utf-8"))
+    # Keep only what is tracked and within the per-folder cap while reading;
+    # once every tracked folder is full the rest of the file is never parsed
+    cap = int(max_items_per_folder)
+    by_folder: dict[str, list[dict]] = {f: [] for f in tracked_folders}
+    open_folders = sum(1 for items in by_folder.values() if len(items) < cap)
 
-    by_folder: dict[str, list[dict]] = {}
-    for m in raw:
+    for m in _iter_json_array(inbox_json_path):
+        if not open_folders:
+            break
         folder = str(m.get("folder_path", "") or "Inbox")
-        by_folder.setdefault(folder, []).append(m)
+        items = by_folder.get(folder)
+        if items is None or len(items) >= cap:
+            continue
+        items.append(m)
+        if len(items) == cap:
+            open_folders -= 1
+
+    # One directory listing instead of a stat per attachment (scandir's
+    # is_file() uses the d_type from the listing on most filesystems)
+    with os.scandir(attachments_dir) as entries:
+        attachment_files = {e.name for e in entries if e.is_file()}
 
     messages: list[JsonMessage] = []
     for folder in tracked_folders:
-        items = (by_folder.get(folder, []) or [])[: int(max_items_per_folder)]
+        items = by_folder[folder]
 
         for m in items:
             mid = str(m.get("message_id", "")).strip() or f"MSG-{len(messages)+1:04d}"
@@ -358,7 +427,8 @@ def _load_json_messages(
                     continue
 
                 src_path = attachments_dir / src_file
-                if not src_path.exists():
+                # Names with a subdirectory (or not listed) still get a real check
+                if src_file not in attachment_files and not src_path.exists():
                     raise FileNotFoundError(
                         f"Attachment missing: {src_path} (referenced by message_id={mid})"
                     )
@@ -386,18 +456,33 @@ def _save_and_hash_pdf(
     att: JsonAttachmentRef,
 ) -> PdfAttachment:
     """
-    Copy attachment into staging with deterministic filename, then hash.
+    Copy attachment into staging, hashing in the same pass.
+
+    The staged file is named <document_hash>.pdf so downstream stages can index
+    staging by filename instead of re-hashing it. The copy lands under a
+    per-attachment temp name first: the same PDF on two messages hashes to the
+    same target, and os.replace keeps concurrent copies from interleaving.
+    The temp name comes from mkstemp, so it is unique even when two messages
+    share an id suffix and an attachment name (copies run in a thread pool).
     """
     staging_dir.mkdir(parents=True, exist_ok=True)
 
     mid_short = short_message_id(message_id)
-    safe_name = safe_filename(att.file_name)
-
-    save_name = f"{mid_short}_{attachment_index:02d}_{safe_name}"
-    save_path = staging_dir / save_name
+    fd, tmp_name = tempfile.mkstemp(
+        dir=staging_dir,
+        prefix=f".{safe_filename(mid_short)}_{attachment_index:02d}_",
+        suffix=".part",
+    )
+    os.close(fd)
+    tmp_path = Path(tmp_name)
 
-    shutil.copyfile(att.source_path, save_path)
-    document_hash = sha256_file(save_path)
+    try:
+        document_hash = copy_and_hash(att.source_path, tmp_path)
+        save_path = staging_dir / f"{document_hash}.pdf"
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
     return PdfAttachment(
         attachment_index=attachment_index,
@@ -417,6 +502,7 @@ def scan_outlook_to_db(
     mailbox_name: str = "DEMO_MAILBOX",
     tracked_folders: Optional[list[str]] = None,
     max_items_per_folder: Optional[int] = None,
+    conn: Optional[sqlite3.Connection] = None,
 ) -> dict:
     """
     Scan inbox messages from JSON + attachments folder and persist results into SQLite.
@@ -424,6 +510,7 @@ def scan_outlook_to_db(
     Public repo:
     - JSON-based adapter only
     - No Outlook integration
+    - Uses `conn` when given (caller keeps ownership), else opens its own
     """
     cfg = _get_config()
 
@@ -438,50 +525,90 @@ def scan_outlook_to_db(
     messages_seen = 0
     pdfs_saved = 0
 
-    conn = get_connection()
-    try:
-        conn.execute("BEGIN")
-        begin_scan(conn, scan_ts)
-
-        messages = _load_json_messages(
-            cfg.inbox_json,
-            cfg.attachments_dir,
-            tracked_folders=list(tracked_folders),
-            max_items_per_folder=cap,
-        )
+    messages = _load_json_messages(
+        cfg.inbox_json,
+        cfg.attachments_dir,
+        tracked_folders=list(tracked_folders),
+        max_items_per_folder=cap,
+    )
 
-        folders_scanned = len({m.folder_path for m in messages})
+    folders_scanned = len({m.folder_path for m in messages})
+
+    # Copy + hash every attachment up front, in parallel (hashlib releases the
+    # GIL), and before the write transaction so the DB lock is held only for
+    # the upserts. map() keeps results in message/attachment order.
+    # Safe to run concurrently only because no two jobs write the same path:
+    # each copy goes to its own mkstemp temp file, and the <hash>.pdf it is
+    # renamed to only ever receives identical bytes.
+    jobs = [(msg, idx, att) for msg in messages for idx, att in enumerate(msg.attachments, start=1)]
+    if jobs:
+        with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+            pdfs = list(pool.map(lambda j: _save_and_hash_pdf(cfg.staging_dir, j[0].message_id, j[1], j[2]), jobs))
+    else:
+        pdfs = []
+    pdf_iter = iter(pdfs)
+
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+
+        # Columns collected in scan order (one list per column), zipped into the
+        # rows _message_row / _invoice_row would build right before executemany.
+        # Repeated upserts of a message only ever differed in attachment_count
+        # (last one wins), so each message with PDFs is written once with its
+        # final PDF count.
+        msg_ids: list[str] = []
+        msg_locations: list[str] = []
+        msg_received: list[Optional[str]] = []
+        msg_senders: list[Optional[str]] = []
+        msg_subjects: list[Optional[str]] = []
+        msg_pdf_counts: list[int] = []
+
+        inv_hashes: list[str] = []
+        inv_message_ids: list[str] = []
+        inv_file_names: list[str] = []
+        inv_folders: list[str] = []
 
         for msg in messages:
             messages_seen += 1
-            attachment_count = len(msg.attachments)
-
-            pdf_count_for_message = 0
-            for idx, att in enumerate(msg.attachments, start=1):
-                pdf_count_for_message += 1
-                pdf = _save_and_hash_pdf(cfg.staging_dir, msg.message_id, idx, att)
-                pdfs_saved += 1
-
-                upsert_message(
-                    conn,
-                    message_id=msg.message_id,
-                    current_location=msg.folder_path,
-                    scan_ts=scan_ts,
-                    received_datetime=msg.received_datetime,
-                    sender_address=msg.sender_address,
-                    subject=msg.subject,
-                    has_attachments=attachment_count > 0,
-                    attachment_count=pdf_count_for_message,  # PDFs only
-                )
+            if not msg.attachments:
+                continue
+
+            for att in msg.attachments:
+                pdf = next(pdf_iter)
+                inv_hashes.append(pdf.document_hash)
+                inv_message_ids.append(msg.message_id)
+                inv_file_names.append(att.file_name)
+                inv_folders.append(msg.folder_path)
+
+            pdfs_saved += len(msg.attachments)
+
+            msg_ids.append(msg.message_id)
+            msg_locations.append(msg.folder_path)
+            msg_received.append(msg.received_datetime)
+            msg_senders.append(msg.sender_address)
+            msg_subjects.append(msg.subject)
+            msg_pdf_counts.append(len(msg.attachments))  # PDFs only
+
+        ts = repeat(scan_ts)
+        conn.executemany(
+            _UPSERT_MESSAGE_SQL,
+            zip(
+                msg_ids, msg_locations, ts, ts, ts,  # first_seen (insert), last_seen, last_scan
+                msg_received, msg_senders, msg_subjects,
+                repeat(1),  # has_attachments
+                msg_pdf_counts,
+            ),
+        )
+        conn.executemany(
+            _UPSERT_INVOICE_SQL,
+            zip(inv_hashes, inv_message_ids, inv_file_names, ts, ts, ts, inv_folders),
+        )
 
-                upsert_invoice(
-                    conn,
-                    document_hash=pdf.document_hash,
-                    message_id=msg.message_id,
-                    attachment_file_name=att.file_name,
-                    scan_ts=scan_ts,
-                    source_folder_path=msg.folder_path,
-                )
+        end_scan(conn, scan_ts, seen_message_ids=msg_ids, seen_document_hashes=inv_hashes)
+        write_ageing_rows(conn)
 
         conn.commit()
 
@@ -489,7 +616,8 @@ def scan_outlook_to_db(
         conn.rollback()
         raise
     finally:
-        conn.close()
+        if owns_conn:
+            conn.close()
 
     return {
         "messages_seen": messages_seen,
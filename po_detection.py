@@ -1,12 +1,16 @@
 from __future__ import annotations
 
+import json
 import os
 import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
 import pdfplumber  # pip install pdfplumber
+import pypdfium2 as pdfium  # pip install pypdfium2 (also a pdfplumber dependency)
 
 from db import get_connection
 from fingerprint import sha256_file
@@ -35,6 +39,7 @@ DEBUG_PREVIEW_MAX_CHARS_PER_LINE = 140
 
 
 def _debug(msg: str) -> None:
+    # Hot loops guard call sites with `if DEBUG:` so the f-string is never built
     if DEBUG:
         print(msg)
 
@@ -103,18 +108,19 @@ def normalize_po_digits(digits: str) -> str:
     return f"PO-{cleaned}"
 
 
+# 'P' then 'O' (any case), with any spaces/dashes between, after and around
+# them, running up to the end of the searched window
+_PO_MARKER_TAIL_RE = re.compile(rf"P[\s{_DASH_CHARS}]*O[\s{_DASH_CHARS}]*\Z", re.IGNORECASE)
+
+
 def allow_bare_po_match(text: str, match: re.Match) -> bool:
     """
-    Suppress a '123456' match if it is immediately preceded by 'PO' (with spaces/dashes),
+    Suppress a '123456' match if it is immediately preceded by 'PO' (with spaces/dashes,
+    including 'P O' / 'P-O'), judged within the 16 characters before the digits,
     so we don't double-count from overlapping patterns.
     """
     start = match.start()
-    if start == 0:
-        return True
-
-    window = text[max(0, start - 16): start]
-    collapsed = re.sub(rf"[\s{_DASH_CHARS}]+", "", window).upper()
-    return not collapsed.endswith("PO")
+    return _PO_MARKER_TAIL_RE.search(text, max(0, start - 16), start) is None
 
 
 PO_PATTERNS: List[PoPattern] = [
@@ -147,32 +153,178 @@ PO_PATTERNS: List[PoPattern] = [
 ]
 
 
+# Every variant above starts with a word boundary and then "PO", "Purchase"
+# or a digit. Extend this class when adding a variant that starts otherwise.
+_PO_LEAD_CHARS = "p0-9"
+
+# One alternation over every variant, so each text is scanned once.
+# The leading lookahead lets the engine skip positions that cannot start any
+# variant instead of trying all four branches at every character.
+# Named groups p0..pN map a hit back to its PoPattern (see detect_po_numbers).
+_COMBINED_PO_REGEX = re.compile(
+    rf"(?=[{_PO_LEAD_CHARS}])(?:"
+    + "|".join(f"(?P<p{i}>{p.regex.pattern})" for i, p in enumerate(PO_PATTERNS))
+    + ")",
+    re.IGNORECASE,
+)
+_PATTERN_BY_GROUP: Dict[str, PoPattern] = {f"p{i}": p for i, p in enumerate(PO_PATTERNS)}
+
+
 # ---------------------------- PDF text extraction ----------------------------
 
+def iter_pdf_pages(pdf_path: Path) -> Iterator[str]:
+    """
+    Yield each page's text layer in page order ("" for a page without one).
+    Raises whatever pdfplumber raises; callers decide how to degrade.
+    """
+    with pdfplumber.open(str(pdf_path)) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text() or ""
+            yield page_text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def try_extract_text_from_pdf(pdf_path: Path) -> Optional[str]:
+    """
+    extract_text_from_pdf, but None (not "") when extraction raised, so
+    callers that persist the text can tell a failed read (locked file,
+    truncated copy, parser bug) from a PDF with no text layer.
+    """
+    try:
+        return "\n".join(iter_pdf_pages(pdf_path)).strip()
+    except Exception:
+        return None
+
+
 def extract_text_from_pdf(pdf_path: Path) -> str:
     """
     Deterministic text extraction.
     Returns concatenated text across pages.
     If no usable text layer, returns "".
     """
+    text = try_extract_text_from_pdf(pdf_path)
+    return "" if text is None else text
+
+
+def _iter_pdfium_pages(pdf_path: Path) -> Iterator[str]:
+    """
+    iter_pdf_pages via PDFium's text layer: no layout analysis, several times
+    faster than pdfplumber, but lines come in content-stream order.
+    """
+    pdf = pdfium.PdfDocument(str(pdf_path))
     try:
-        chunks: List[str] = []
-        with pdfplumber.open(str(pdf_path)) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text() or ""
-                page_text = page_text.replace("\r\n", "\n").replace("\r", "\n")
-                chunks.append(page_text)
-        return "\n".join(chunks).strip()
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                page_text = textpage.get_text_range()
+            finally:
+                textpage.close()
+                page.close()
+            yield page_text.replace("\r\n", "\n").replace("\r", "\n")
+    finally:
+        pdf.close()
+
+
+# Tail of the text read so far, rescanned with each page, so a PO token split
+# across the page break (or its 16-char bare-PO lookback) is still seen.
+# Counted in non-whitespace characters, since the patterns' \s* runs are
+# unbounded; any hit reaching the new page starts well inside the tail, so a
+# token cut at the tail's start can only yield hits that are filtered out.
+_PAGE_OVERLAP_CHARS = 64
+
+
+def _overlap_tail(text: str) -> str:
+    start = len(text)
+    kept = 0
+    while start > 0 and kept < _PAGE_OVERLAP_CHARS:
+        start -= 1
+        if not text[start].isspace():
+            kept += 1
+    return text[start:]
+
+
+def _read_po_text(pages: Iterator[str]) -> str:
+    # Stop once the pages so far hold two distinct POs: the outcome is
+    # MULTIPLE_POS whatever the remaining pages say. Each page is scanned once
+    # (plus the overlap), not the whole buffer again.
+    chunks: List[str] = []
+    seen: set[str] = set()
+    tail = ""
+    for page_text in pages:
+        chunks.append(page_text)
+        window = f"{tail}\n{page_text}" if len(chunks) > 1 else page_text
+        # Hits wholly inside the tail were already counted with the previous page
+        body_start = len(window) - len(page_text)
+        seen.update(po for match, po in _iter_po_hits(window) if match.end() > body_start)
+        if len(seen) >= 2:
+            break
+
+        # Tail of the text so far, not just this page (a page may be blank)
+        tail = _overlap_tail(window)
+    return "\n".join(chunks).strip()
+
+
+def extract_po_text(pdf_path: Path) -> str:
+    """
+    extract_text_from_pdf for PO detection.
+
+    - Reads the PDFium text layer first (PO tokens do not depend on layout);
+      falls back to pdfplumber if PDFium fails or finds no text, so the
+      NO_TEXT_LAYER outcome is still pdfplumber's call
+    - Stops reading pages once two distinct POs are found. Single-PO and
+      PO-less invoices read every page, so their outcome is unchanged; for
+      MULTIPLE_POS, po_numbers/po_count cover the pages read
+    - Value extraction keeps the layout-aware pdfplumber text
+    """
+    try:
+        text = _read_po_text(_iter_pdfium_pages(pdf_path))
+    except Exception:
+        text = ""
+    if text:
+        return text
+
+    try:
+        return _read_po_text(iter_pdf_pages(pdf_path))
     except Exception:
         return ""
 
 
+_T = TypeVar("_T")
+
+
+def _pdf_workers() -> int:
+    # ICS_PDF_WORKERS=1 disables the process pool (default: one per CPU)
+    raw = os.getenv("ICS_PDF_WORKERS", "").strip()
+    try:
+        n = int(raw) if raw else (os.cpu_count() or 1)
+    except ValueError:
+        n = os.cpu_count() or 1
+    return max(n, 1)
+
+
+def extract_texts_from_pdfs(
+    pdf_paths: List[Path],
+    extract: Callable[[Path], _T] = extract_text_from_pdf,
+) -> List[_T]:
+    """
+    `extract` (a module-level function, so it pickles) over many PDFs, results
+    in input order. pdfplumber parsing is pure-Python CPU work, so a process
+    pool gives real parallelism; with one worker (or one PDF) it runs inline.
+    """
+    workers = min(_pdf_workers(), len(pdf_paths))
+    if workers <= 1:
+        return [extract(p) for p in pdf_paths]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(pdf_paths) // (workers * 4))
+        return list(pool.map(extract, pdf_paths, chunksize=chunksize))
+
+
 # ---------------------------- Detection + classification ----------------------------
 
 def detect_po_numbers(text: str) -> List[str]:
     """
     Deterministic PO extraction:
-    - Applies PO_PATTERNS in order
+    - Scans the text once with all PO_PATTERNS combined
     - Normalises to PO-XXXXXX
     - Returns unique values in first-seen order
     """
@@ -182,21 +334,33 @@ def detect_po_numbers(text: str) -> List[str]:
     seen: set[str] = set()
     ordered: List[str] = []
 
-    for pattern in PO_PATTERNS:
-        for match in pattern.regex.finditer(text):
-            if pattern.allow is not None and not pattern.allow(text, match):
-                continue
+    for _, po in _iter_po_hits(text):
+        if po not in seen:
+            seen.add(po)
+            ordered.append(po)
 
-            try:
-                po = pattern.normalizer(match)
-            except ValueError:
-                continue
+    return ordered
 
-            if po not in seen:
-                seen.add(po)
-                ordered.append(po)
 
-    return ordered
+def _iter_po_hits(text: str) -> Iterator[Tuple[re.Match, str]]:
+    # (match, normalised PO) per accepted hit, in text order (duplicates included)
+    for hit in _COMBINED_PO_REGEX.finditer(text):
+        pattern = _PATTERN_BY_GROUP[hit.lastgroup]
+
+        # Re-anchor the winning variant so normalizer/allow see its own groups
+        match = pattern.regex.match(text, hit.start())
+        if match is None:
+            continue
+
+        if pattern.allow is not None and not pattern.allow(text, match):
+            continue
+
+        try:
+            po = pattern.normalizer(match)
+        except ValueError:
+            continue
+
+        yield match, po
 
 
 def classify_po_result(text: str, po_numbers: List[str]) -> PoDetectionResult:
@@ -214,19 +378,27 @@ def classify_po_result(text: str, po_numbers: List[str]) -> PoDetectionResult:
 
 # ---------------------------- Staging index (hash -> file) ----------------------------
 
+_HASH_STEM_RE = re.compile(r"[0-9a-f]{64}")
+
 def index_staging_pdfs(staging_dir: Path) -> Dict[str, Path]:
     """
     Deterministically map document_hash -> staged PDF path.
-    If duplicates exist (same hash saved multiple times), keep the first by sorted path order.
+
+    The scanner stages each PDF as <document_hash>.pdf, so the hash is read
+    from the filename. Any other *.pdf (e.g. staged by an older scanner) is
+    hashed as before. If duplicates exist, keep the first by sorted path order.
     """
     pdf_paths = sorted(staging_dir.glob("*.pdf"))
     mapping: Dict[str, Path] = {}
 
     for p in pdf_paths:
-        try:
-            h = sha256_file(p)
-        except Exception:
-            continue
+        if _HASH_STEM_RE.fullmatch(p.stem):
+            h = p.stem
+        else:
+            try:
+                h = sha256_file(p)
+            except Exception:
+                continue
 
         if h not in mapping:
             mapping[h] = p
@@ -236,10 +408,22 @@ def index_staging_pdfs(staging_dir: Path) -> Dict[str, Path]:
 
 # ---------------------------- DB writeback ----------------------------
 
-def write_po_results(conn, *, document_hash: str, result: PoDetectionResult) -> None:
-    cur = conn.cursor()
+def write_po_results_many(
+    conn,
+    results: List[Tuple[str, PoDetectionResult]],
+    *,
+    cur: Optional[sqlite3.Cursor] = None,
+) -> None:
+    """
+    Write (document_hash, result) pairs: one prepared statement per step.
+    Pass `cur` to reuse the caller's cursor.
+    """
+    if not results:
+        return
+
+    cur = cur or conn.cursor()
 
-    cur.execute(
+    cur.executemany(
         """
         UPDATE inbox_invoice
         SET
@@ -248,40 +432,62 @@ def write_po_results(conn, *, document_hash: str, result: PoDetectionResult) ->
             po_validation_status = 'UNVALIDATED'
         WHERE document_hash = ?
         """,
-        (result.po_count, result.match_status, document_hash),
+        [(r.po_count, r.match_status, h) for h, r in results],
     )
 
-    cur.execute("DELETE FROM invoice_po WHERE document_hash = ?", (document_hash,))
-    for po in result.po_numbers:
-        cur.execute(
-            """
-            INSERT INTO invoice_po (document_hash, po_number)
-            VALUES (?, ?)
-            """,
-            (document_hash, po),
-        )
+    # Prune only POs no longer detected; identical reruns then delete nothing and
+    # the (document_hash, po_number) primary key turns re-inserts into no-ops.
+    # The PO list travels as one JSON parameter so a single statement fits every row.
+    cur.executemany(
+        """
+        DELETE FROM invoice_po
+        WHERE document_hash = ?
+          AND po_number NOT IN (SELECT value FROM json_each(?))
+        """,
+        [(h, json.dumps(r.po_numbers)) for h, r in results],
+    )
+    cur.executemany(
+        """
+        INSERT OR IGNORE INTO invoice_po (document_hash, po_number)
+        VALUES (?, ?)
+        """,
+        [(h, po) for h, r in results for po in r.po_numbers],
+    )
+
+
+def write_po_results(
+    conn,
+    *,
+    document_hash: str,
+    result: PoDetectionResult,
+    cur: Optional[sqlite3.Cursor] = None,
+) -> None:
+    write_po_results_many(conn, [(document_hash, result)], cur=cur)
 
 
 # ---------------------------- Runner ----------------------------
 
-def run_po_detection(*, staging_dir: Path) -> dict:
+def run_po_detection(*, staging_dir: Path, conn: Optional[sqlite3.Connection] = None) -> dict:
     """
     - Build hash->path index from staging
     - Fetch currently-present invoices needing scan
-    - Extract text, detect PO(s), classify, write back
+    - Extract text (process pool, see ICS_PDF_WORKERS), detect PO(s), classify
+    - Write all results back in one transaction
+    - Uses `conn` when given (caller keeps ownership), else opens its own
     """
     hash_to_path = index_staging_pdfs(staging_dir)
 
-    conn = get_connection()
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_connection()
     processed = 0
     missing_file = 0
     no_text = 0
 
     try:
-        conn.execute("BEGIN")
-
-        cur = conn.cursor()
-        rows = cur.execute(
+        # Served by the partial index idx_invoice_po_unscanned (db.py): keep the WHERE in step.
+        # Rows are consumed as the cursor yields them; only the hash strings are kept.
+        cur = conn.execute(
             """
             SELECT document_hash
             FROM inbox_invoice
@@ -289,49 +495,57 @@ def run_po_detection(*, staging_dir: Path) -> dict:
               AND (po_match_status IS NULL OR po_match_status = 'UNSCANNED')
             ORDER BY document_hash ASC
             """
-        ).fetchall()
+        )
+        candidates: List[str] = [row[0] for row in cur]
 
-        _debug(f"[PO] Candidate invoices needing detection: {len(rows)}")
+        _debug(f"[PO] Candidate invoices needing detection: {len(candidates)}")
         _debug(f"[PO] Staging index size: {len(hash_to_path)}")
 
-        for r in rows:
-            document_hash = r["document_hash"]
+        # Extract every available PDF up front (in parallel), outside any write lock
+        found = [(h, hash_to_path[h]) for h in candidates if h in hash_to_path]
+        texts = dict(zip((h for h, _ in found), extract_texts_from_pdfs([p for _, p in found], extract_po_text)))
+
+        results: List[Tuple[str, PoDetectionResult]] = []
+        for document_hash in candidates:
             pdf_path = hash_to_path.get(document_hash)
 
-            _debug(f"[PO] Processing {document_hash} (pdf_found={bool(pdf_path)})")
+            if DEBUG:
+                _debug(f"[PO] Processing {document_hash} (pdf_found={bool(pdf_path)})")
 
             if not pdf_path:
-                write_po_results(
-                    conn,
-                    document_hash=document_hash,
-                    result=PoDetectionResult([], 0, FILE_MISSING),
-                )
+                results.append((document_hash, PoDetectionResult([], 0, FILE_MISSING)))
                 missing_file += 1
                 processed += 1
                 continue
 
-            text = extract_text_from_pdf(pdf_path)
-            _debug(f"[PO] Extracted text length: {len(text) if text else 0}")
-            _debug_preview_text(text)
+            text = texts[document_hash]
+            if DEBUG:
+                _debug(f"[PO] Extracted text length: {len(text) if text else 0}")
+                _debug_preview_text(text)
 
             po_numbers = detect_po_numbers(text)
             result = classify_po_result(text, po_numbers)
 
-            _debug(f"[PO] Result: {result.match_status} | po_count={result.po_count} | pos={result.po_numbers}")
+            if DEBUG:
+                _debug(f"[PO] Result: {result.match_status} | po_count={result.po_count} | pos={result.po_numbers}")
 
             if result.match_status == NO_TEXT_LAYER:
                 no_text += 1
 
-            write_po_results(conn, document_hash=document_hash, result=result)
+            results.append((document_hash, result))
             processed += 1
 
+        # One short write transaction for the whole batch
+        conn.execute("BEGIN IMMEDIATE")
+        write_po_results_many(conn, results)
         conn.commit()
 
     except Exception:
         conn.rollback()
         raise
     finally:
-        conn.close()
+        if owns_conn:
+            conn.close()
 
     return {
         "processed": processed,
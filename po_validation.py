@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import sqlite3
+
+from ageing import write_ageing_rows
 from db import get_connection
 
 # Truth values expected in po_master (demo-safe)
@@ -17,7 +20,7 @@ STATUS_VALID_PO = "VALID_PO"
 STATUS_SINGLE_PO_DETECTED = "SINGLE_PO_DETECTED"
 
 
-def run_po_validation() -> dict:
+def run_po_validation(*, conn: sqlite3.Connection | None = None) -> dict:
     """
     Validate detected POs against po_master.
 
@@ -30,23 +33,21 @@ def run_po_validation() -> dict:
     Writes:
     - inbox_invoice.po_validation_status
     - inbox_invoice.ready_to_post (canonical dashboard/worklist flag)
+    - invoice_ageing (lanes follow ready_to_post; same transaction)
 
     V1 behaviour:
     - Re-validates all currently-present SINGLE_PO_DETECTED invoices each run
       (reflects any changes in po_master)
     - Excludes invoices with posted_datetime NOT NULL (terminal)
+    - Uses `conn` when given (caller keeps ownership), else opens its own
     """
-    conn = get_connection()
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_connection()
     cur = conn.cursor()
 
-    validated = 0
-    valid = 0
-    not_in_master = 0
-    not_open = 0
-    not_confirmed = 0
-
     try:
-        conn.execute("BEGIN")
+        conn.execute("BEGIN IMMEDIATE")
 
         # Defensive: anything not SINGLE_PO_DETECTED cannot be "ready"
         cur.execute(
@@ -73,62 +74,65 @@ def run_po_validation() -> dict:
             (STATUS_UNVALIDATED, STATUS_SINGLE_PO_DETECTED),
         )
 
-        # Pull the PO + master truth for all eligible invoices
-        rows = cur.execute(
+        # Classify every eligible invoice in one set-based statement (SQLite 3.33+)
+        cur.execute(
             """
-            SELECT
-                ii.document_hash,
-                ip.po_number,
-                pm.po_status,
-                pm.approval_status
-            FROM inbox_invoice ii
-            JOIN invoice_po ip
-                ON ii.document_hash = ip.document_hash
+            UPDATE inbox_invoice AS ii
+            SET po_validation_status = CASE
+                    WHEN pm.po_status IS NULL THEN ?
+                    WHEN pm.po_status <> ? THEN ?
+                    WHEN pm.approval_status IS NOT ? THEN ?
+                    ELSE ?
+                END,
+                ready_to_post = CASE
+                    WHEN pm.po_status = ? AND pm.approval_status = ? THEN 1
+                    ELSE 0
+                END
+            FROM invoice_po ip
             LEFT JOIN po_master pm
                 ON ip.po_number = pm.po_number
-            WHERE ii.is_currently_present = 1
+            WHERE ii.document_hash = ip.document_hash
+              AND ii.is_currently_present = 1
               AND ii.posted_datetime IS NULL
               AND ii.po_match_status = ?
             """,
-            (STATUS_SINGLE_PO_DETECTED,),
-        ).fetchall()
-
-        for row in rows:
-            document_hash = row["document_hash"]
-            po_status = row["po_status"]
-            approval_status = row["approval_status"]
-
-            if po_status is None:
-                new_status = STATUS_PO_NOT_IN_MASTER
-                ready_to_post = 0
-                not_in_master += 1
-
-            elif po_status != VALID_OPEN_STATUS:
-                new_status = STATUS_PO_NOT_OPEN
-                ready_to_post = 0
-                not_open += 1
-
-            elif approval_status != VALID_APPROVAL_STATUS:
-                new_status = STATUS_PO_NOT_CONFIRMED
-                ready_to_post = 0
-                not_confirmed += 1
-
-            else:
-                new_status = STATUS_VALID_PO
-                ready_to_post = 1
-                valid += 1
+            (
+                STATUS_PO_NOT_IN_MASTER,
+                VALID_OPEN_STATUS,
+                STATUS_PO_NOT_OPEN,
+                VALID_APPROVAL_STATUS,
+                STATUS_PO_NOT_CONFIRMED,
+                STATUS_VALID_PO,
+                VALID_OPEN_STATUS,
+                VALID_APPROVAL_STATUS,
+                STATUS_SINGLE_PO_DETECTED,
+            ),
+        )
 
+        # Counters come from the result rather than from a Python loop
+        counts = dict(
             cur.execute(
                 """
-                UPDATE inbox_invoice
-                SET po_validation_status = ?,
-                    ready_to_post = ?
-                WHERE document_hash = ?
+                SELECT ii.po_validation_status, COUNT(*)
+                FROM inbox_invoice ii
+                JOIN invoice_po ip
+                    ON ii.document_hash = ip.document_hash
+                WHERE ii.is_currently_present = 1
+                  AND ii.posted_datetime IS NULL
+                  AND ii.po_match_status = ?
+                GROUP BY ii.po_validation_status
                 """,
-                (new_status, ready_to_post, document_hash),
-            )
+                (STATUS_SINGLE_PO_DETECTED,),
+            ).fetchall()
+        )
+
+        valid = counts.get(STATUS_VALID_PO, 0)
+        not_in_master = counts.get(STATUS_PO_NOT_IN_MASTER, 0)
+        not_open = counts.get(STATUS_PO_NOT_OPEN, 0)
+        not_confirmed = counts.get(STATUS_PO_NOT_CONFIRMED, 0)
+        validated = valid + not_in_master + not_open + not_confirmed
 
-            validated += 1
+        write_ageing_rows(conn)
 
         conn.commit()
 
@@ -137,7 +141,8 @@ def run_po_validation() -> dict:
         raise
 
     finally:
-        conn.close()
+        if owns_conn:
+            conn.close()
 
     return {
         "validated": validated,
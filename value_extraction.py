@@ -2,12 +2,16 @@ from __future__ import annotations
 
 import os
 import re
+import sqlite3
+import tempfile
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
+from ageing import write_ageing_rows
 from db import get_connection
-from po_detection import index_staging_pdfs, extract_text_from_pdf
+from po_detection import extract_texts_from_pdfs, index_staging_pdfs, try_extract_text_from_pdf
 
 """
 Value Extraction (V1) — Public-safe
@@ -15,6 +19,7 @@ Value Extraction (V1) — Public-safe
 - Deterministic rules (no ML)
 - Uses the same PDF text extraction as po_detection (one source of truth)
 - Writes net/vat/gross totals (pence) back into inbox_invoice
+  (and refreshes the invoice_ageing cache in the same transaction)
 - Does NOT overwrite PO-related statuses (separation of concerns)
 """
 
@@ -27,6 +32,7 @@ DEBUG_PREVIEW_MAX_CHARS_PER_LINE = 140
 
 
 def _debug(msg: str) -> None:
+    # Hot loops guard call sites with `if DEBUG:` so the f-string is never built
     if DEBUG:
         print(msg)
 
@@ -70,23 +76,19 @@ def _money_to_pence(amount_str: str) -> int:
     if not s:
         raise ValueError("Blank amount")
 
-    if "." in s:
-        pounds, pence = s.split(".", 1)
-        pence = (pence + "00")[:2]
-    else:
-        pounds, pence = s, "00"
+    # No dot -> pence "" -> "00"; C-level str ops beat a per-character loop here
+    pounds, _, pence = s.partition(".")
+    return int(pounds) * 100 + int((pence + "00")[:2])
 
-    return int(pounds) * 100 + int(pence)
 
-
-def _first_match_pence(pattern: re.Pattern[str], text: str) -> Optional[int]:
-    m = pattern.search(text)
+def _match_pence(m: Optional[re.Match[str]]) -> Optional[int]:
+    # Same result as _money_to_pence on "whole.dec", straight from the groups
+    # (whole always starts with a digit; ".5" -> 50 pence)
     if not m:
         return None
-    whole = m.group(1)
-    dec = m.group(2) or ""
-    num = f"{whole}.{dec}" if dec else whole
-    return _money_to_pence(num)
+    whole, dec = m.group(1, 2)
+    pence = int((dec + "00")[:2]) if dec else 0
+    return int(whole.replace(",", "")) * 100 + pence
 
 
 # ----------------------------
@@ -117,6 +119,54 @@ LABELED_TOTAL_RE = re.compile(
 )
 
 
+_VALUE_PATTERNS = (
+    NET_AMOUNT_RE,
+    VAT_AMOUNT_RE,
+    TOTAL_AMOUNT_RE,
+    DUE_AMOUNT_RE,
+    SINGLE_TOTAL_RE,
+    LABELED_TOTAL_RE,
+)
+
+# Every pattern above starts with \b and one of these words, so each pattern's
+# first match (what .search would return) starts at one of this scanner's hits.
+# Keep in step when adding a pattern. The lookahead lets the engine skip
+# positions that cannot start a word in the list.
+_LEAD_WORDS_RE = re.compile(
+    r"(?=[nvtdiabg])\b(?:NET|VAT|TOTAL|DUE|INVOICE|AMOUNT|BALANCE|GRAND)\b",
+    re.IGNORECASE,
+)
+
+# Bound methods, resolved once at import rather than per call in the loop below
+_has_digit = re.compile(r"[0-9]").search
+_find_lead_words = _LEAD_WORDS_RE.finditer
+_VALUE_MATCHERS = tuple((pattern, pattern.match) for pattern in _VALUE_PATTERNS)
+
+# Once these three have matched, rule A's result is fixed whatever follows
+# (DUE AMOUNT is only a fallback for a missing TOTAL AMOUNT)
+_DECISIVE = frozenset((NET_AMOUNT_RE, VAT_AMOUNT_RE, TOTAL_AMOUNT_RE))
+
+
+def _first_matches(text: str) -> Dict[re.Pattern[str], re.Match[str]]:
+    """
+    First match of every _VALUE_PATTERNS entry, from one pass over the text:
+    each lead-word hit tries the still-unmatched patterns anchored there.
+    Stops early once the extract_values outcome can no longer change
+    (see _DECISIVE), so a typical Net/VAT/Total block ends the scan there.
+    """
+    found: Dict[re.Pattern[str], re.Match[str]] = {}
+    for hit in _find_lead_words(text):
+        pos = hit.start()
+        for pattern, match in _VALUE_MATCHERS:
+            if pattern not in found:
+                m = match(text, pos)
+                if m:
+                    found[pattern] = m
+        if _DECISIVE <= found.keys():
+            break
+    return found
+
+
 def extract_values(text: str) -> ValueResult:
     """
     Deterministic V1 extraction:
@@ -127,123 +177,246 @@ def extract_values(text: str) -> ValueResult:
     """
     if not text or not text.strip():
         return ValueResult(None, None, None, "NO_TEXT")
+    return _extract_values_cached(text)
+
 
-    net = _first_match_pence(NET_AMOUNT_RE, text)
-    vat = _first_match_pence(VAT_AMOUNT_RE, text)
+# Pure function of the text and ValueResult is frozen, so identical texts
+# (re-runs in one process, duplicate PDFs) reuse the result. Bounded because
+# each entry keeps its text alive.
+@lru_cache(maxsize=1024)
+def _extract_values_cached(text: str) -> ValueResult:
+    # Every rule needs an amount starting with an ASCII digit: no digit, no scan
+    if not _has_digit(text):
+        return ValueResult(None, None, None, "NOT_FOUND")
+
+    found = _first_matches(text)
+
+    net = _match_pence(found.get(NET_AMOUNT_RE))
+    vat = _match_pence(found.get(VAT_AMOUNT_RE))
 
     if net is not None or vat is not None:
-        gross = _first_match_pence(TOTAL_AMOUNT_RE, text)
+        gross = _match_pence(found.get(TOTAL_AMOUNT_RE))
         if gross is None:
-            gross = _first_match_pence(DUE_AMOUNT_RE, text)
+            gross = _match_pence(found.get(DUE_AMOUNT_RE))
         return ValueResult(net, vat, gross, "EXPLICIT_NET_VAT_BLOCK")
 
-    gross_only = _first_match_pence(SINGLE_TOTAL_RE, text)
+    gross_only = _match_pence(found.get(SINGLE_TOTAL_RE))
     if gross_only is not None:
         return ValueResult(None, None, gross_only, "SINGLE_TOTAL_LINE")
 
-    gross_labeled = _first_match_pence(LABELED_TOTAL_RE, text)
+    gross_labeled = _match_pence(found.get(LABELED_TOTAL_RE))
     if gross_labeled is not None:
         return ValueResult(None, None, gross_labeled, "LABELED_TOTAL")
 
     return ValueResult(None, None, None, "NOT_FOUND")
 
 
+# ----------------------------
+# Extracted-text cache (staging/.ics_text_cache)
+# ----------------------------
+
+# document_hash fingerprints the PDF bytes, so a cached text never goes stale
+# for its PDF. Bump the version to discard every entry (e.g. after changing
+# how text is extracted).
+TEXT_CACHE_DIRNAME = ".ics_text_cache"
+TEXT_CACHE_VERSION = "v1"
+
+
+def _text_cache_path(cache_dir: Path, document_hash: str) -> Path:
+    return cache_dir / TEXT_CACHE_VERSION / document_hash[:2] / f"{document_hash}.txt"
+
+
+def _read_cached_text(cache_dir: Path, document_hash: str) -> Optional[str]:
+    try:
+        return _text_cache_path(cache_dir, document_hash).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+def _write_cached_text(cache_dir: Path, document_hash: str, text: str) -> None:
+    # Write-then-rename so a concurrent or interrupted run never sees half a file
+    path = _text_cache_path(cache_dir, document_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=path.parent, suffix=".part", delete=False
+    ) as fh:
+        fh.write(text)
+    os.replace(fh.name, path)
+
+
+def extract_texts_cached(found: List[Tuple[str, Path]], cache_dir: Path) -> Dict[str, str]:
+    """
+    document_hash -> extract_text_from_pdf text for (document_hash, pdf_path)
+    pairs, memoised on disk by document_hash.
+
+    Cache misses are parsed together in a process pool (extract_texts_from_pdfs,
+    see ICS_PDF_WORKERS); cache reads and writes stay in this process. A blank
+    text layer is cached too (a scanned PDF stays a gross_total IS NULL
+    candidate and would otherwise be re-parsed on every run), but a read that
+    raised is returned as "" for this run only and retried on the next.
+    """
+    texts: Dict[str, str] = {}
+    misses: List[Tuple[str, Path]] = []
+    for document_hash, pdf_path in found:
+        cached = _read_cached_text(cache_dir, document_hash)
+        if cached is None:
+            misses.append((document_hash, pdf_path))
+        else:
+            texts[document_hash] = cached
+
+    extracted = extract_texts_from_pdfs([p for _, p in misses], try_extract_text_from_pdf)
+    for (document_hash, _), text in zip(misses, extracted):
+        if text is None:
+            if DEBUG:
+                _debug(f"[VALUE] Text extraction failed for {document_hash}; not cached")
+            texts[document_hash] = ""
+            continue
+        _write_cached_text(cache_dir, document_hash, text)
+        texts[document_hash] = text
+
+    return texts
+
+
 # ----------------------------
 # DB writeback
 # ----------------------------
 
-def write_value_results(conn, *, document_hash: str, result: ValueResult) -> None:
+_UPDATE_VALUES_SQL = """
+    UPDATE inbox_invoice
+    SET net_total = ?,
+        vat_total = ?,
+        gross_total = ?
+    WHERE document_hash = ?
+"""
+
+
+def write_value_results_many(
+    conn,
+    results: List[Tuple[str, ValueResult]],
+    *,
+    cur: Optional[sqlite3.Cursor] = None,
+) -> None:
     """
+    Write (document_hash, result) pairs with one prepared UPDATE.
     Only writes value fields. Does not mutate PO detection/validation statuses.
     """
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE inbox_invoice
-        SET net_total = ?,
-            vat_total = ?,
-            gross_total = ?
-        WHERE document_hash = ?
-        """,
-        (result.net_pence, result.vat_pence, result.gross_pence, document_hash),
+    if not results:
+        return
+
+    (cur or conn.cursor()).executemany(
+        _UPDATE_VALUES_SQL,
+        [(r.net_pence, r.vat_pence, r.gross_pence, h) for h, r in results],
     )
 
 
+def write_value_results(
+    conn,
+    *,
+    document_hash: str,
+    result: ValueResult,
+    cur: Optional[sqlite3.Cursor] = None,
+) -> None:
+    write_value_results_many(conn, [(document_hash, result)], cur=cur)
+
+
 # ----------------------------
 # Runner (staging -> DB)
 # ----------------------------
 
-def run_value_extraction(*, staging_dir: Path) -> dict:
+def run_value_extraction(*, staging_dir: Path, conn: Optional[sqlite3.Connection] = None) -> dict:
     """
     - Build hash->path index from staging
-    - For present invoices, extract/write values
+    - For present invoices, extract values (process pool, see ICS_PDF_WORKERS;
+      text cached under <staging_dir>/.ics_text_cache, keyed by document_hash)
+    - Write all results back in one transaction
     - Only process invoices where gross_total IS NULL (or 0) to stay idempotent
     - Does not change PO statuses
+    - Uses `conn` when given (caller keeps ownership), else opens its own
     """
     hash_to_path = index_staging_pdfs(staging_dir)
+    text_cache_dir = staging_dir / TEXT_CACHE_DIRNAME
 
-    conn = get_connection()
+    owns_conn = conn is None
+    if conn is None:
+        conn = get_connection()
     processed = 0
     missing_file = 0
     values_found = 0
     no_text_layer = 0
 
     try:
-        conn.execute("BEGIN")
         cur = conn.cursor()
-        rows = cur.execute(
-            """
-            SELECT document_hash
-            FROM inbox_invoice
-            WHERE is_currently_present = 1
-              AND (gross_total IS NULL OR gross_total = 0)
-            ORDER BY document_hash ASC
-            """
-        ).fetchall()
-
-        _debug(f"[VALUE] Candidate invoices needing extraction: {len(rows)}")
+        candidates: List[str] = [
+            row[0]
+            for row in cur.execute(
+                """
+                SELECT document_hash
+                FROM inbox_invoice
+                WHERE is_currently_present = 1
+                  AND (gross_total IS NULL OR gross_total = 0)
+                ORDER BY document_hash ASC
+                """
+            )
+        ]
+
+        _debug(f"[VALUE] Candidate invoices needing extraction: {len(candidates)}")
         _debug(f"[VALUE] Staging index size: {len(hash_to_path)}")
 
-        for r in rows:
-            document_hash = r["document_hash"]
+        # Extract every available PDF up front (cache, then process pool), outside any write lock
+        texts = extract_texts_cached(
+            [(h, hash_to_path[h]) for h in candidates if h in hash_to_path],
+            text_cache_dir,
+        )
+
+        results: List[Tuple[str, ValueResult]] = []
+        for document_hash in candidates:
             pdf_path = hash_to_path.get(document_hash)
 
-            _debug(f"[VALUE] Processing {document_hash} (pdf_found={bool(pdf_path)})")
+            if DEBUG:
+                _debug(f"[VALUE] Processing {document_hash} (pdf_found={bool(pdf_path)})")
 
             if not pdf_path:
                 missing_file += 1
                 continue
 
-            text = extract_text_from_pdf(pdf_path)
+            text = texts[document_hash]
 
-            _debug(f"[VALUE] Extracted text length: {len(text) if text else 0}")
-            _debug_preview_text(text)
+            if DEBUG:
+                _debug(f"[VALUE] Extracted text length: {len(text) if text else 0}")
+                _debug_preview_text(text)
 
             result = extract_values(text)
 
-            _debug(
-                f"[VALUE] Rule fired: {result.rule} | gross_pence={result.gross_pence} | "
-                f"net={result.net_pence} | vat={result.vat_pence}"
-            )
+            if DEBUG:
+                _debug(
+                    f"[VALUE] Rule fired: {result.rule} | gross_pence={result.gross_pence} | "
+                    f"net={result.net_pence} | vat={result.vat_pence}"
+                )
 
             if result.rule == "NO_TEXT":
                 no_text_layer += 1
                 # Leave values NULL; do not mutate other statuses.
                 continue
 
-            write_value_results(conn, document_hash=document_hash, result=result)
+            results.append((document_hash, result))
 
             processed += 1
             if result.gross_pence is not None:
                 values_found += 1
 
-        conn.commit()
+        # One short write transaction for the whole batch
+        if results:
+            conn.execute("BEGIN IMMEDIATE")
+            write_value_results_many(conn, results, cur=cur)
+            write_ageing_rows(conn)
+            conn.commit()
 
     except Exception:
         conn.rollback()
         raise
     finally:
-        conn.close()
+        if owns_conn:
+            conn.close()
 
     return {
         "processed": processed,
@@ -8,6 +8,7 @@ V1 Worklist (Joblist) for ICS
 - Writes:
     - invoice_worklist (current cache, full-replace per run)
     - invoice_worklist_history (append-only snapshots per run)
+    - invoice_worklist_run (one row per refresh; run_seq orders the runs)
 
 V1 model:
 - No manual dismissal state
@@ -20,6 +21,14 @@ Outlook usability:
     - attachment_name
     - received_datetime
 
+Full replace:
+- ICS_WORKLIST_REPLACE=delete (default): DELETE + INSERT in place
+- ICS_WORKLIST_REPLACE=recreate: build a fresh copy of invoice_worklist and swap
+  it in (same DDL + indexes), instead of deleting every row. Faster on large
+  worklists, but it is DDL on every refresh: schema_version bumps, so every
+  open connection (e.g. the dashboard) re-parses the schema and re-reads its
+  schema cache
+
 Debug:
 - Controlled via ICS_DEBUG env var
 - Prints summary of action changes vs previous run (history table)
@@ -28,11 +37,12 @@ Debug:
 from __future__ import annotations
 
 import os
+import re
 import sqlite3
 import uuid
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 from po_validation import (
     STATUS_PO_NOT_CONFIRMED,
@@ -47,6 +57,9 @@ from po_validation import (
 _ENV_DEBUG = os.getenv("ICS_DEBUG", "").strip().lower()
 DEBUG = _ENV_DEBUG in ("1", "true", "yes", "y", "on")
 
+_ENV_REPLACE = os.getenv("ICS_WORKLIST_REPLACE", "").strip().lower()
+REPLACE_MODE = _ENV_REPLACE if _ENV_REPLACE in ("recreate", "delete") else "delete"
+
 # If you want to hard-link these, you can import from po_detection instead of strings:
 STATUS_NO_TEXT_LAYER = "NO_TEXT_LAYER"
 STATUS_MISSING_PO = "MISSING_PO"
@@ -80,30 +93,161 @@ def _new_run_id() -> str:
     return uuid.uuid4().hex
 
 
-def _extract_sender_domain(sender_address: Optional[str]) -> Optional[str]:
-    """
-    Extract domain from a sender identifier.
+# ----------------------------
+# Classification rules (V1)
+# ----------------------------
+# Single source of truth: both refresh_worklist_tables (INSERT ... SELECT) and
+# build_worklist read rows from _worklist_select_sql.
+#
+# Priority: lower = earlier attention in the queue.
+#
+# Precedence (V1), first match wins:
+# 1) Not currently present
+# 2) No text layer
+# 3) Missing PO
+# 4) Multiple POs
+# 5) PO validation blockers (single PO detected)
+# 6) Ready to post
+# 7) Gross missing (needs value entry / confirmation)
+# 8) Catch-all manual review
+#
+# Status and sender strings are compared after trimming ASCII whitespace
+# (space, \t, \n, \v, \f, \r); SQLite's one-argument trim() strips spaces only.
+_TRIM_CHARS = "char(32, 9, 10, 11, 12, 13)"
+
+# Sender identifier -> domain:
+# - SMTP sender: "john@acme.com" -> "acme.com"
+# - Exchange legacy DN: "/O=EXCH.../CN=..." -> "internal"
+# - Anything else -> NULL
+_SENDER_DOMAIN_SQL = f"""
+    CASE
+        WHEN substr(ltrim(im.sender_address, {_TRIM_CHARS}), 1, 3) IN ('/O=', '\\O=') THEN 'internal'
+        WHEN instr(im.sender_address, '@') > 0
+            THEN nullif(
+                lower(trim(substr(im.sender_address, instr(im.sender_address, '@') + 1), {_TRIM_CHARS})),
+                ''
+            )
+    END
+"""
 
-    Cases:
-    - SMTP sender: "john@acme.com" -> "acme.com"
-    - Exchange legacy DN: "/O=EXCH.../CN=..." -> "internal"
-    - Anything else -> None
-    """
-    if not sender_address:
-        return None
+# Priority alone identifies the outcome, so next_action / action_reason are
+# derived from it in the outer SELECT of _worklist_select_sql
+_MATCH_STATUS_SQL = f"trim(ii.po_match_status, {_TRIM_CHARS})"
+_VALIDATION_STATUS_SQL = f"coalesce(trim(ii.po_validation_status, {_TRIM_CHARS}), '')"
+_PRIORITY_SQL = f"""
+    CASE
+        WHEN ii.is_currently_present = 0 THEN 90
+        WHEN {_MATCH_STATUS_SQL} = :no_text_layer THEN 10
+        WHEN {_MATCH_STATUS_SQL} = :missing_po THEN 20
+        WHEN {_MATCH_STATUS_SQL} = :multiple_pos THEN 30
+        WHEN {_MATCH_STATUS_SQL} = :single_po AND {_VALIDATION_STATUS_SQL} = :not_open THEN 35
+        WHEN {_MATCH_STATUS_SQL} = :single_po AND {_VALIDATION_STATUS_SQL} = :not_confirmed THEN 36
+        WHEN {_MATCH_STATUS_SQL} = :single_po AND {_VALIDATION_STATUS_SQL} = :not_in_master THEN 40
+        WHEN {_MATCH_STATUS_SQL} = :single_po AND {_VALIDATION_STATUS_SQL} = :unvalidated THEN 50
+        WHEN {_MATCH_STATUS_SQL} = :single_po AND {_VALIDATION_STATUS_SQL} <> :valid_po THEN 55
+        WHEN ii.ready_to_post = 1 THEN 5
+        WHEN ii.gross_total IS NULL THEN 60
+        ELSE 80
+    END
+"""
 
-    s = str(sender_address).strip()
-    if not s:
-        return None
+_CLASSIFY_PARAMS = {
+    "no_text_layer": STATUS_NO_TEXT_LAYER,
+    "missing_po": STATUS_MISSING_PO,
+    "multiple_pos": STATUS_MULTIPLE_POS,
+    "single_po": STATUS_SINGLE_PO_DETECTED,
+    "not_open": STATUS_PO_NOT_OPEN,
+    "not_confirmed": STATUS_PO_NOT_CONFIRMED,
+    "not_in_master": STATUS_PO_NOT_IN_MASTER,
+    "unvalidated": STATUS_UNVALIDATED,
+    "valid_po": STATUS_VALID_PO,
+}
+
+_WORKLIST_COLUMNS = """
+    document_hash,
+    sender_domain,
+    email_subject,
+    attachment_name,
+    received_datetime,
+    next_action,
+    action_reason,
+    priority,
+    generated_at_utc,
+    is_currently_present
+"""
 
-    if s.startswith("/O=") or s.startswith("\\O="):
-        return "internal"
 
-    if "@" in s:
-        dom = s.split("@", 1)[1].strip().lower()
-        return dom or None
+def _worklist_select_sql(*, only_currently_present: bool, include_ready_to_post: bool) -> str:
+    where_clause = "WHERE ii.is_currently_present = 1" if only_currently_present else ""
+    ready_clause = "WHERE priority <> 5" if not include_ready_to_post else ""
+    return f"""
+        SELECT
+            document_hash,
+            sender_domain,
+            email_subject,
+            attachment_name,
+            received_datetime,
+            CASE priority
+                WHEN 90 THEN 'NOT CURRENTLY PRESENT'
+                WHEN 5 THEN 'READY TO POST'
+                ELSE 'MANUAL REVIEW'
+            END,
+            CASE priority
+                WHEN 90 THEN 'NOT IN INBOX THIS SCAN'
+                WHEN 10 THEN 'NO TEXT LAYER'
+                WHEN 20 THEN 'MISSING PO'
+                WHEN 30 THEN 'MULTIPLE POS DETECTED'
+                WHEN 35 THEN 'PO NOT OPEN'
+                WHEN 36 THEN 'PO NOT CONFIRMED'
+                WHEN 40 THEN 'PO NOT IN MASTER'
+                WHEN 50 THEN 'PO NOT VALIDATED YET'
+                WHEN 55 THEN 'UNKNOWN PO VALIDATION STATUS'
+                WHEN 5 THEN 'VALID PO'
+                WHEN 60 THEN 'GROSS TOTAL NOT EXTRACTED'
+                ELSE 'UNCLASSIFIED STATE'
+            END,
+            priority,
+            :generated_at_utc,
+            is_currently_present
+        FROM (
+            SELECT
+                ii.document_hash,
+                {_SENDER_DOMAIN_SQL} AS sender_domain,
+                im.subject              AS email_subject,
+                ii.attachment_file_name AS attachment_name,
+                im.received_datetime    AS received_datetime,
+                {_PRIORITY_SQL} AS priority,
+                ii.is_currently_present
+            FROM inbox_invoice ii
+            LEFT JOIN inbox_message im
+                   ON im.message_id = ii.message_id
+            {where_clause}
+        )
+        {ready_clause}
+    """
 
-    return None
+
+def _iter_classified(
+    conn: sqlite3.Connection,
+    *,
+    only_currently_present: bool,
+    include_ready_to_post: bool,
+    generated_at_utc: str,
+) -> Iterator[Tuple[Any, ...]]:
+    """
+    Yield classified worklist rows as tuples in invoice_worklist column order,
+    ordered by (priority, document_hash) by SQLite.
+    """
+    select_sql = _worklist_select_sql(
+        only_currently_present=only_currently_present,
+        include_ready_to_post=include_ready_to_post,
+    )
+    cur = conn.cursor()
+    cur.row_factory = None
+    yield from cur.execute(
+        f"{select_sql} ORDER BY priority, document_hash;",
+        {**_CLASSIFY_PARAMS, "generated_at_utc": generated_at_utc},
+    )
 
 
 def build_worklist(
@@ -122,58 +266,69 @@ def build_worklist(
     - Does NOT write to DB.
     - Precedence-based: first blocker wins.
     - Includes Outlook identifiers so AP users can locate the invoice in Outlook.
+    - Ordered by priority then hash (sorted in SQL, not in Python).
     """
-    generated_at_utc = _utc_now_iso()
     run_id = _new_run_id()
+    rows = _iter_classified(
+        conn,
+        only_currently_present=only_currently_present,
+        include_ready_to_post=include_ready_to_post,
+        generated_at_utc=_utc_now_iso(),
+    )
+    return run_id, [WorkItem(*row) for row in rows]
 
-    where_clause = "WHERE ii.is_currently_present = 1" if only_currently_present else ""
 
-    rows = conn.execute(
-        f"""
-        SELECT
-            ii.document_hash,
-            ii.is_currently_present,
-            ii.po_match_status,
-            ii.po_validation_status,
-            ii.ready_to_post,
-            ii.gross_total,
-
-            ii.attachment_file_name AS attachment_name,
-            im.sender_address       AS sender_address,
-            im.subject              AS email_subject,
-            im.received_datetime    AS received_datetime
-        FROM inbox_invoice ii
-        LEFT JOIN inbox_message im
-               ON im.message_id = ii.message_id
-        {where_clause}
-        """
-    ).fetchall()
+# ----------------------------
+# Refresh (INSERT ... SELECT, no rows through Python)
+# ----------------------------
+_CREATE_WORKLIST_RE = re.compile(
+    r'^CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?"?invoice_worklist"?',
+    re.IGNORECASE,
+)
 
-    items: List[WorkItem] = []
-    for r in rows:
-        next_action, action_reason, priority = _classify_invoice(r)
-
-        if not include_ready_to_post and next_action == "READY TO POST":
-            continue
-
-        items.append(
-            WorkItem(
-                document_hash=r["document_hash"],
-                sender_domain=_extract_sender_domain(r["sender_address"]),
-                email_subject=r["email_subject"],
-                attachment_name=r["attachment_name"],
-                received_datetime=r["received_datetime"],
-                next_action=next_action,
-                action_reason=action_reason,
-                priority=priority,
-                generated_at_utc=generated_at_utc,
-                is_currently_present=int(r["is_currently_present"]),
-            )
+
+def _recreate_worklist(conn: sqlite3.Connection, select_sql: str, params: Dict[str, Any]) -> int:
+    """
+    Fill a fresh invoice_worklist__new from select_sql and swap it in.
+
+    The copy is created from invoice_worklist's own stored DDL, so constraints
+    and migrated columns carry over; its indexes are rebuilt after the rename.
+    With foreign_keys on, DELETE FROM visits (and FK-checks) every old row,
+    whereas DROP TABLE on this child-only table just frees its pages.
+    DROP TABLE also drops the table's sqlite_stat1 rows, so the new copy is
+    re-analysed before returning.
+    Must run inside the caller's transaction. Returns rows written.
+    """
+    table_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'invoice_worklist';"
+    ).fetchone()[0]
+    index_sqls = [
+        r[0]
+        for r in conn.execute(
+            """
+            SELECT sql
+            FROM sqlite_master
+            WHERE type = 'index'
+              AND tbl_name = 'invoice_worklist'
+              AND sql IS NOT NULL;
+            """
         )
+    ]
+
+    conn.execute("DROP TABLE IF EXISTS invoice_worklist__new;")
+    conn.execute(_CREATE_WORKLIST_RE.sub("CREATE TABLE invoice_worklist__new", table_sql, count=1))
+    total_items = conn.execute(
+        f"INSERT INTO invoice_worklist__new ({_WORKLIST_COLUMNS}) {select_sql};",
+        params,
+    ).rowcount
+
+    conn.execute("DROP TABLE invoice_worklist;")
+    conn.execute("ALTER TABLE invoice_worklist__new RENAME TO invoice_worklist;")
+    for index_sql in index_sqls:
+        conn.execute(index_sql)
+    conn.execute("ANALYZE invoice_worklist;")
 
-    # Deterministic ordering: priority then hash
-    items.sort(key=lambda x: (x.priority, x.document_hash))
-    return run_id, items
+    return total_items
 
 
 def refresh_worklist_tables(
@@ -185,88 +340,49 @@ def refresh_worklist_tables(
     """
     Full-replace refresh of invoice_worklist + append-only snapshot to history.
 
+    Classification runs inside SQLite (INSERT ... SELECT from
+    _worklist_select_sql), so no rows cross into Python.
+    REPLACE_MODE picks DELETE + INSERT (default) or swap-in-a-fresh-copy.
+
     Returns:
         run_id for this refresh.
     """
-    run_id, items = build_worklist(
-        conn,
+    run_id = _new_run_id()
+    select_sql = _worklist_select_sql(
         only_currently_present=only_currently_present,
         include_ready_to_post=include_ready_to_post,
     )
 
     with conn:
-        conn.execute("DELETE FROM invoice_worklist;")
-
-        conn.executemany(
-            """
-            INSERT INTO invoice_worklist (
-                document_hash,
-                sender_domain,
-                email_subject,
-                attachment_name,
-                received_datetime,
-                next_action,
-                action_reason,
-                priority,
-                generated_at_utc,
-                is_currently_present
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        # Explicit: connections run with isolation_level=None (no implicit BEGIN)
+        conn.execute("BEGIN IMMEDIATE")
+        params = {**_CLASSIFY_PARAMS, "generated_at_utc": _utc_now_iso()}
+
+        if REPLACE_MODE == "recreate":
+            total_items = _recreate_worklist(conn, select_sql, params)
+        else:
+            conn.execute("DELETE FROM invoice_worklist;")
+            total_items = conn.execute(
+                f"INSERT INTO invoice_worklist ({_WORKLIST_COLUMNS}) {select_sql};",
+                params,
+            ).rowcount
+
+        # Snapshot is a straight copy of the rows just written
+        conn.execute(
+            f"""
+            INSERT INTO invoice_worklist_history (run_id, {_WORKLIST_COLUMNS})
+            SELECT ?, {_WORKLIST_COLUMNS}
+            FROM invoice_worklist;
             """,
-            [
-                (
-                    i.document_hash,
-                    i.sender_domain,
-                    i.email_subject,
-                    i.attachment_name,
-                    i.received_datetime,
-                    i.next_action,
-                    i.action_reason,
-                    i.priority,
-                    i.generated_at_utc,
-                    i.is_currently_present,
-                )
-                for i in items
-            ],
+            (run_id,),
         )
-
-        conn.executemany(
-            """
-            INSERT INTO invoice_worklist_history (
-                run_id,
-                document_hash,
-                sender_domain,
-                email_subject,
-                attachment_name,
-                received_datetime,
-                next_action,
-                action_reason,
-                priority,
-                generated_at_utc,
-                is_currently_present
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-            """,
-            [
-                (
-                    run_id,
-                    i.document_hash,
-                    i.sender_domain,
-                    i.email_subject,
-                    i.attachment_name,
-                    i.received_datetime,
-                    i.next_action,
-                    i.action_reason,
-                    i.priority,
-                    i.generated_at_utc,
-                    i.is_currently_present,
-                )
-                for i in items
-            ],
+        conn.execute(
+            "INSERT INTO invoice_worklist_run (run_id, generated_at_utc) VALUES (?, ?);",
+            (run_id, params["generated_at_utc"]),
         )
 
     if DEBUG:
-        _debug_worklist_delta(conn, run_id, total_items=len(items))
+        _debug_worklist_delta(conn, run_id, total_items=total_items)
 
     return run_id
 
@@ -300,12 +416,14 @@ def fetch_current_worklist(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
 # Debug helpers
 # ----------------------------
 def _debug_worklist_delta(conn: sqlite3.Connection, run_id: str, *, total_items: int) -> None:
+    # Runs are ordered by run_seq (generated_at_utc only has one-second
+    # resolution); both lookups are served by invoice_worklist_run's keys
     prev = conn.execute(
         """
         SELECT run_id
-        FROM invoice_worklist_history
-        WHERE run_id <> ?
-        ORDER BY id DESC
+        FROM invoice_worklist_run
+        WHERE run_seq < (SELECT run_seq FROM invoice_worklist_run WHERE run_id = ?)
+        ORDER BY run_seq DESC
         LIMIT 1
         """,
         (run_id,),
@@ -321,22 +439,31 @@ def _debug_worklist_delta(conn: sqlite3.Connection, run_id: str, *, total_items:
 
     prev_run_id = prev["run_id"]
 
+    # One pass over both runs: LAG pairs each document's current action with its
+    # previous-run action (rows come off the (run_id, document_hash) primary key)
     changes = conn.execute(
         """
         SELECT
-            prev.next_action AS prev_action,
-            curr.next_action AS curr_action,
+            prev_action,
+            curr_action,
             COUNT(*) AS count
-        FROM invoice_worklist_history prev
-        JOIN invoice_worklist_history curr
-          ON prev.document_hash = curr.document_hash
-        WHERE prev.run_id = ?
-          AND curr.run_id = ?
-          AND prev.next_action <> curr.next_action
-        GROUP BY prev.next_action, curr.next_action
+        FROM (
+            SELECT
+                run_id,
+                LAG(next_action) OVER (
+                    PARTITION BY document_hash
+                    ORDER BY run_id = :run_id
+                ) AS prev_action,
+                next_action AS curr_action
+            FROM invoice_worklist_history
+            WHERE run_id IN (:prev_run_id, :run_id)
+        )
+        WHERE run_id = :run_id
+          AND prev_action <> curr_action
+        GROUP BY prev_action, curr_action
         ORDER BY count DESC;
         """,
-        (prev_run_id, run_id),
+        {"prev_run_id": prev_run_id, "run_id": run_id},
     ).fetchall()
 
     total_changed = sum(r["count"] for r in changes)
@@ -348,72 +475,3 @@ def _debug_worklist_delta(conn: sqlite3.Connection, run_id: str, *, total_items:
 
     for r in changes:
         print(f"  {r['prev_action']} → {r['curr_action']}: {r['count']}")
-
-
-# ----------------------------
-# Classification rules (V1)
-# ----------------------------
-def _gross_missing(row: sqlite3.Row) -> bool:
-    return row["gross_total"] is None
-
-
-def _classify_invoice(row: sqlite3.Row) -> Tuple[str, str, int]:
-    """
-    Return (next_action, action_reason, priority).
-
-    Priority: lower = earlier attention in the queue.
-
-    Precedence (V1):
-    1) No text layer
-    2) Missing PO
-    3) Multiple POs
-    4) PO validation blockers (single PO detected)
-    5) Ready to post
-    6) Gross missing (needs value entry / confirmation)
-    7) Catch-all manual review
-    """
-    if int(row["is_currently_present"]) == 0:
-        return ("NOT CURRENTLY PRESENT", "NOT IN INBOX THIS SCAN", 90)
-
-    po_match_status = (row["po_match_status"] or "").strip()
-    po_validation_status = (row["po_validation_status"] or "").strip()
-    ready_to_post = int(row["ready_to_post"]) if row["ready_to_post"] is not None else 0
-
-    # Highest urgency blockers first (lowest priority number)
-    if po_match_status == STATUS_NO_TEXT_LAYER:
-        return ("MANUAL REVIEW", "NO TEXT LAYER", 10)
-
-    if po_match_status == STATUS_MISSING_PO:
-        return ("MANUAL REVIEW", "MISSING PO", 20)
-
-    if po_match_status == STATUS_MULTIPLE_POS:
-        return ("MANUAL REVIEW", "MULTIPLE POS DETECTED", 30)
-
-    if po_match_status == STATUS_SINGLE_PO_DETECTED:
-        if po_validation_status == STATUS_PO_NOT_OPEN:
-            return ("MANUAL REVIEW", "PO NOT OPEN", 35)
-        if po_validation_status == STATUS_PO_NOT_CONFIRMED:
-            return ("MANUAL REVIEW", "PO NOT CONFIRMED", 36)
-        if po_validation_status == STATUS_PO_NOT_IN_MASTER:
-            return ("MANUAL REVIEW", "PO NOT IN MASTER", 40)
-        if po_validation_status == STATUS_UNVALIDATED:
-            return ("MANUAL REVIEW", "PO NOT VALIDATED YET", 50)
-
-        if po_validation_status not in (
-            STATUS_UNVALIDATED,
-            STATUS_PO_NOT_IN_MASTER,
-            STATUS_PO_NOT_OPEN,
-            STATUS_PO_NOT_CONFIRMED,
-            STATUS_VALID_PO,
-        ):
-            return ("MANUAL REVIEW", "UNKNOWN PO VALIDATION STATUS", 55)
-
-    # Green lane
-    if ready_to_post == 1:
-        return ("READY TO POST", "VALID PO", 5)
-
-    # Value missing (only matters if not ready)
-    if _gross_missing(row):
-        return ("MANUAL REVIEW", "GROSS TOTAL NOT EXTRACTED", 60)
-
-    return ("MANUAL REVIEW", "UNCLASSIFIED STATE", 80)